@@ -6,6 +6,11 @@ import pandas as pd
 from shapely.geometry import Point
 from tqdm import tqdm
 import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+import hashlib
+import json
+import os
 
 
 def add_huc_col_to_hucs(HUC8, HUC10, HUC12):
@@ -15,33 +20,114 @@ def add_huc_col_to_hucs(HUC8, HUC10, HUC12):
     strings in the dataframe. This allows us to identify the HUC8 and HUC10 (for HUC12 watersheds) 
     watersheds and the HUC8 (for HUC10 watersheds) watersheds. These identifiers are useful for 
     working with other shape files that lie in their same watersheds
+
+    All HUC codes are stored as 64-bit integers. Parent codes are derived from the integer codes 
+    directly; a HUC10 code is its HUC8 code followed by two digits, and a HUC12 code is its HUC10 
+    code followed by two digits
     """
     
-    # Add watershed columns
-    HUC10["huc8"]  = ''
-    HUC12["huc8"]  = ''
-    HUC12["huc10"] = ''
-
-    # Fill these columns based on their HUC10 or HUC12 codes
-    for i in range(len(HUC10)):
-        HUC10.huc8.iloc[i]     = HUC10.huc10.iloc[i][0:8]
-    for i in range(len(HUC12)):
-        HUC12.huc8.iloc[i]     = HUC12.huc12.iloc[i][0:8]
-        HUC12.huc10.iloc[i]    = HUC12.huc12.iloc[i][0:10]
-        
-    
     # Convert the strings of the above dataframes to integers
-    HUC8['huc8']   = HUC8['huc8'].astype(int) 
-    HUC10['huc8']  = HUC10['huc8'].astype(int)
-    HUC10['huc10'] = HUC10['huc10'].astype(int)
-    HUC12['huc8']  = pd.to_numeric(HUC12['huc8'])
-    HUC12['huc10'] = pd.to_numeric(HUC12['huc10'])
-    HUC12['huc12'] = pd.to_numeric(HUC12['huc12'])
+    HUC8['huc8']   = pd.to_numeric(HUC8['huc8']).astype(np.int64)
+    HUC10['huc10'] = pd.to_numeric(HUC10['huc10']).astype(np.int64)
+    HUC12['huc12'] = pd.to_numeric(HUC12['huc12']).astype(np.int64)
+
+    # Add watershed columns by dropping the last digits of the HUC10 or HUC12 codes
+    HUC10['huc8']  = HUC10['huc10'] // 100
+    HUC12['huc8']  = HUC12['huc12'] // 10000
+    HUC12['huc10'] = HUC12['huc12'] // 100
     
     # Return the HUC8, HUC10, and HUC12 watersheds with their idnetifiers
     return HUC8, HUC10, HUC12
 
-def add_HUC8(shp, huc8):
+def huc_lookup_table(huc12):
+    """
+    Build a parent/child lookup table for a set of HUC12 codes. huc12 can be a HUC12 GeoDataFrame 
+    (with a "huc12" column) or a list of HUC12 codes. Returns a dataframe with one row for each unique
+    HUC12 code and integer columns "huc12", "huc10", and "huc8". This table can be merged onto any 
+    dataframe with a HUC12 column to get the HUC10 and HUC8 codes without any spatial operations
+    """
+
+    if isinstance(huc12, pd.DataFrame):
+        huc12 = huc12['huc12'].values
+
+    # Get the unique HUC12 codes as integers
+    codes = np.unique(pd.to_numeric(pd.Series(np.asarray(huc12).ravel())).astype(np.int64).values)
+
+    # Derive the parent codes from the HUC12 codes
+    lookup = pd.DataFrame({"huc12": codes, "huc10": codes // 100, "huc8": codes // 10000})
+
+    return lookup
+
+def _assign_codes(points, polys, codes, point_parents=None, poly_parents=None, on_boundary="min"):
+    """
+    Assign to each point the code of the polygon that it lies within. This uses a single bulk query
+    against the spatial index of the polygons rather than testing every point against every polygon.
+
+    If point_parents and poly_parents are given, a point can only be assigned to a polygon with the
+    same parent code (e.g., a HUC10 polygon that lies in the HUC8 of the point). If a point lies within 
+    more than one polygon, the lowest code is used. Points that are not within any polygon are given a 
+    code of 0. If on_boundary = "min", points that lie exactly on a polygon boundary (e.g., on the boundary
+    shared by two HUCs) are given the lowest code of the polygons they touch; if on_boundary = None, these
+    points are given a code of 0
+    """
+
+    codes    = np.asarray(codes)
+    assigned = np.zeros(len(points), dtype=np.int64)
+
+    def match(point_idx, predicate):
+        # Get all (point, polygon) pairs that satisfy the predicate
+        pairs = polys.sindex.query(points.values[point_idx], predicate=predicate)
+        pt_idx, poly_idx = point_idx[pairs[0]], pairs[1]
+
+        # Remove any pairs where the polygon is not in the parent HUC of the point
+        if point_parents is not None:
+            keep = np.asarray(poly_parents)[poly_idx] == np.asarray(point_parents)[pt_idx]
+            pt_idx, poly_idx = pt_idx[keep], poly_idx[keep]
+
+        # Sort the pairs by point, then by code, and keep the first (lowest) code of each point
+        order    = np.lexsort((codes[poly_idx], pt_idx))
+        pt_idx   = pt_idx[order]
+        poly_idx = poly_idx[order]
+        first    = np.ones(len(pt_idx), dtype=bool)
+        first[1:] = pt_idx[1:] != pt_idx[:-1]
+
+        assigned[pt_idx[first]] = codes[poly_idx[first]]
+
+    # Assign codes to points that lie within a polygon
+    match(np.arange(len(points)), "within")
+
+    # Assign codes to points that were not within any polygon, but lie on a polygon boundary
+    if on_boundary == "min":
+        unassigned = np.flatnonzero(assigned == 0)
+        if len(unassigned) > 0:
+            match(unassigned, "intersects")
+    elif on_boundary is not None:
+        raise ValueError("on_boundary must be 'min' or None")
+
+    return assigned
+
+def assign_hucs(shp, huc8, huc10, huc12, on_boundary="min"):
+    """
+    Add HUC8, HUC10, and HUC12 locations to shp file in a single pass. If the centroid of an object in the shp
+    file is in a HUC, then that HUC code is added to the object. HUC10s are only assigned from within the 
+    object's HUC8, and HUC12s are only assigned from within the object's HUC10. 
+
+    This gives the same result as calling add_HUC8, add_HUC10, and add_HUC12, but uses the spatial index
+    of the HUC GeoDataFrames to avoid testing every centroid against every HUC polygon. If a centroid lies 
+    in more than one HUC, or on the boundary shared by two HUCs, the lowest HUC code is used (see _assign_codes)
+    """
+
+    print("Running assign_hucs over GeoPandas dataframe")
+
+    points = shp.centroid
+
+    shp["huc8"]  = _assign_codes(points, huc8.geometry, huc8.huc8.values, on_boundary=on_boundary)
+    shp["huc10"] = _assign_codes(points, huc10.geometry, huc10.huc10.values, shp.huc8.values, huc10.huc8.values, on_boundary)
+    shp["huc12"] = _assign_codes(points, huc12.geometry, huc12.huc12.values, shp.huc10.values, huc12.huc10.values, on_boundary)
+
+    return shp
+
+def add_HUC8(shp, huc8, on_boundary="min"):
     """
     Add HUC8 location to shp file. If centroid of object is in shp file is in a HUC8,
     then that HUC8 code is added to the object
@@ -49,19 +135,11 @@ def add_HUC8(shp, huc8):
     
     print("Running add_HUC8 over GeoPandas dataframe")
     
-    shp["huc8"] = 0
-    polys  = huc8.geometry
-    points = shp.centroid
-    
-    for i in tqdm(range(len(shp))):
-        p = points.iloc[i]
-        for j in range(len(huc8)):
-            if p.within(polys.iloc[j]):
-                shp['huc8'].iloc[i] = huc8.huc8.iloc[j]
+    shp["huc8"] = _assign_codes(shp.centroid, huc8.geometry, huc8.huc8.values, on_boundary=on_boundary)
 
     return shp
 
-def add_HUC10(shp, huc10):
+def add_HUC10(shp, huc10, on_boundary="min"):
     """
     Add HUC12 location to shp file. If centroid of object is in shp file is in a HUC10,
     then that HUC10 code is added to the object
@@ -73,22 +151,11 @@ def add_HUC10(shp, huc10):
     if 'huc8' not in shp.columns:
         raise ValueError("GeoPandas dataframe does not have a 'huc8' columnn")
     
-    shp['huc10'] = 0
-    points = shp.centroid
-
-    for i in tqdm(range(len(shp))):
-        p     = points.iloc[i]
-        
-        hucs  = huc10[huc10.huc8 == shp.huc8.iloc[i]]
-        polys = hucs.geometry
-        for j in range(len(polys)):
-            if p.within(polys.iloc[j]):
-                shp['huc10'].iloc[i] = hucs.huc10.iloc[j]
-                break
+    shp['huc10'] = _assign_codes(shp.centroid, huc10.geometry, huc10.huc10.values, shp.huc8.values, huc10.huc8.values, on_boundary)
                 
     return shp
 
-def add_HUC12(shp, huc12):
+def add_HUC12(shp, huc12, on_boundary="min"):
 
     """
     Add HUC12 location to shp file. If centroid of object is in shp file is in a HUC12,
@@ -101,568 +168,1425 @@ def add_HUC12(shp, huc12):
     if 'huc10' not in shp.columns:
         raise ValueError("GeoPandas dataframe does not have a 'huc10' column")
     
-    shp['huc12'] = 0
-    points = shp.centroid
-    
-    for i in tqdm(range(len(shp))):
-        p     = points.iloc[i] 
-        hucs = huc12[huc12.huc10 == shp.huc10.iloc[i]]
-        polys = hucs.geometry
-        for j in range(len(polys)):
-            if p.within(polys.iloc[j]):
-                shp['huc12'].iloc[i] = hucs.huc12.iloc[j]
-                break
+    shp['huc12'] = _assign_codes(shp.centroid, huc12.geometry, huc12.huc12.values, shp.huc10.values, huc12.huc10.values, on_boundary)
                 
     return shp
 
+def _river_lake_pairs(river_gdf, lake_gdf):
+    """
+    Return the positions of all intersecting river and lake/waterbody objects as two arrays. This uses
+    a single bulk query against the spatial index of the waterbodies rather than testing every river
+    against every waterbody. Pairs are sorted by river position, then by lake position
+    """
+
+    river_idx, lake_idx = lake_gdf.sindex.query(river_gdf.geometry.values, predicate="intersects")
+
+    order = np.lexsort((lake_idx, river_idx))
+
+    return river_idx[order], lake_idx[order]
+
+def river_lake_intersections(river_gdf, lake_gdf):
+    """
+    Identify which rivers intersect which lakes/waterbodies. Returns a two-column dataframe of intersecting 
+    pairs, with the river COMID in "river_COMID" and the waterbody COMID in "lake_COMID". Rows are sorted
+    by the order of the rivers in river_gdf, and then by the order of the waterbodies in lake_gdf
+    """
+
+    river_idx, lake_idx = _river_lake_pairs(river_gdf, lake_gdf)
+
+    edges = pd.DataFrame({
+        "river_COMID": river_gdf.COMID.values[river_idx],
+        "lake_COMID":  lake_gdf.COMID.values[lake_idx],
+    })
+
+    return edges
+
+def _pairs_to_lists(idx, values, n):
+    """
+    Group the values of a sorted set of pairs into one list for each of n objects. idx gives the 
+    (sorted) position of the object for each pair
+    """
+
+    if n == 0:
+        return pd.Series([], dtype=object)
+
+    counts = np.bincount(idx, minlength=n)
+    lists  = [i.tolist() for i in np.split(np.asarray(values), np.cumsum(counts)[:-1])]
+
+    return pd.Series(lists, dtype=object)
+
 def add_lake_river_node_column(river_gdf,lake_gdf):
     """
     Adds a column to each gdf to identify which rivers or lakes the objects
     in that gdf intersect. Returns a river and lake gdf containing a new column
     listing the intersecting objects
+
+    The list columns are built from the same intersections as river_lake_intersections; 
+    use that function directly if the list columns are not needed
     """
     
-    lines = river_gdf.geometry
-    polys = lake_gdf.geometry
-    
-    river_gdf["lake_nodes"] = ""
-    lake_gdf["river_nodes"] = ""
+    river_idx, lake_idx = _river_lake_pairs(river_gdf, lake_gdf)
+
+    # For each waterbody, list the intersecting river segments in the order of river_gdf
+    order = np.lexsort((river_idx, lake_idx))
+    river_nodes = _pairs_to_lists(lake_idx[order], river_gdf.COMID.values[river_idx[order]], len(lake_gdf))
+    lake_gdf["river_nodes"] = river_nodes.values
+
+    # For each river segment, list the intersecting waterbodies in the order of lake_gdf
     river_gdf = river_gdf.reset_index(drop=True)
-    
-    # Add empty list to river and lake gdfs
-    for i in tqdm(range(len(polys))):
-        lake_gdf.river_nodes.iloc[i] = []
-    for i in tqdm(range(len(lines))):
-        river_gdf.lake_nodes.iloc[i] = []
-
-    # If a line intersects a lake polygon, add that lake polygon to the river's list of lakes
-    # and add that river segment to the lake's list of rivers
-    for i in tqdm(range(len(lines))):
-        line = lines.iloc[i]
-        
-        for j in range(len(polys)):
-            if line.intersects(polys.iloc[j]):
-                river_gdf.lake_nodes.iloc[i].append(lake_gdf.COMID.iloc[j])
-                lake_gdf.river_nodes.iloc[j].append(river_gdf.COMID.iloc[i])
-                
+    river_gdf["lake_nodes"] = _pairs_to_lists(river_idx, lake_gdf.COMID.values[lake_idx], len(river_gdf)).values
 
     return river_gdf, lake_gdf
 
-def add_to_tofroms(tofrom, river_gdf,lake_gdf):
+def _map_values(values, mapping):
+    """
+    Replace every value in the array values that is a key of the dictionary mapping with the 
+    corresponding dictionary value. All replacements are applied at once
+    """
+
+    values = np.array(values, copy=True)
+    if len(mapping) == 0:
+        return values
+
+    pos  = pd.Index(list(mapping.keys())).get_indexer(values)
+    mask = pos >= 0
+    values[mask] = np.asarray(list(mapping.values()), dtype=values.dtype)[pos[mask]]
+
+    return values
+
+def add_to_tofroms(tofrom, river_gdf, lake_gdf, edges=None):
     """
     From a given list of to-from COMIDs for the river network, add the lakes/waterbodies to the network.
     This function returns a new to-from list that includes COMIDs for waterbodies
-    """
-    
-    # lake_list_applied is an optional list that keeps track of how many lakes
-    # are impacted by the second for loop below
-    lake_list_applied = []
-
-    # Copy the to froms list so that the original dataframe is not impacted
-    tofroms = tofrom.copy(deep=True)
-
-    # Iterate through all rivers; if a river segment only intersects a single waterbody, 
-    # then replace that river in the to-from list with the waterbody COMID
-    for i in tqdm(range(len(river_gdf))):
-
-        # Test to make sure the river segment only intersects one waterbody
-        if len(river_gdf.lake_nodes.iloc[i]) == 1:
-            # Identify the COMID of the river segment
-            old_COMID = river_gdf.COMID.values[i]
-            # Identify the COMID of the waterbody that is going to replace the river segment
-            new_COMID = river_gdf.lake_nodes.iloc[i][0]
-            
-            new_lake_gdf =  lake_gdf[lake_gdf.COMID == new_COMID].copy(deep=True)
-            
-            # Replace the river COMID with the new lake COMID
-            if len(new_lake_gdf) > 0:
-                tofroms["TOCOMID"]   = tofroms["TOCOMID"].replace(to_replace=old_COMID, value=new_COMID)
-                tofroms["FROMCOMID"] = tofroms["FROMCOMID"].replace(to_replace=old_COMID, value=new_COMID)
-
-    # Iterate through all rivers; if a river segment intersects multiple waterbodies, it will add waterbodies 
-    # to the network only if that waterbody wasn't already added to the network by the first for loop
-    for i in tqdm(range(len(river_gdf))):
-        
 
-        # Test to make sure the river segment intersects multiple waterbodies
-        if len(river_gdf.lake_nodes.iloc[i]) > 1:
-            
-            # Get the set of all waterbodies that are intersected by the river segment
-            all_lakes = river_gdf.lake_nodes.iloc[i]
-            
-            # Get the gdf of the waterbodies intersected by the river segment
-            new_lake_gdf = lake_gdf[lake_gdf.COMID.isin(all_lakes)].copy(deep=True)
-            
-            # Identify the COMID of the river segment
-            old_COMID = river_gdf.COMID.values[i]
-            
-            # Create a list for the COMIDs that need to be added
-            # This list will omit any waterbodies already added through the first for loop
-            lake_comids_to_add = []
-            
-            # Loop through the gdf of intersected waterbodies to build the lake_comids_to_add list
-            for k in range(len(new_lake_gdf)):
-                # Get the COMID of the waterbody to test
-                new_lake_comid = new_lake_gdf.COMID.iloc[k]
-
-                # Test if the waterbody has already been added to the to-from list; if it hasn't,
-                # then add it to the lake_comids_to_add list
-                if len(tofroms[(tofroms.TOCOMID == new_lake_comid) | (tofroms.FROMCOMID == new_lake_comid)]) == 0:
-                    lake_comids_to_add = np.append(lake_comids_to_add, new_lake_comid)
-                    lake_list_applied  = np.append(lake_list_applied, new_lake_comid)
-                    
-            # Identify the length of the lake_comids to add
-            length = len(lake_comids_to_add)
-            
-            # Loop through the lake_comids_to_add list; since the river segment intersects multiple lakes, the river 
-            # segment is going to be replaced by every waterbody in this list; these waterbodies will not be directly
-            # connected to each other, but upstream and downstream connections outside of thew waterbodies will be consistent
-            for j in range(length-1):
-                
-                # Create a copy of the to-froms list, and replace the river segment COMID with the waterbody COMID
-                tofroms_copy = tofroms[(tofroms.FROMCOMID == old_COMID) | (tofroms.TOCOMID == old_COMID)].copy(deep=True)
-                new_COMID = lake_comids_to_add[j]
-                
-                tofroms_copy["TOCOMID"]   = tofroms_copy["TOCOMID"].replace(to_replace=old_COMID, value=new_COMID)
-                tofroms_copy["FROMCOMID"] = tofroms_copy["FROMCOMID"].replace(to_replace=old_COMID, value=new_COMID)
-                
-                tofroms = tofroms.append(tofroms_copy)
-            
-            if length>0:
+    The waterbodies intersected by each river are taken from the lake_nodes column of river_gdf (see 
+    add_lake_river_node_column), or from edges if an edge table from river_lake_intersections is given
+    """
 
-                # Replace the river segment COMID with the final waterbody COMID
-                new_COMID = lake_comids_to_add[length-1]
-            
-                tofroms["TOCOMID"]   = tofroms["TOCOMID"].replace(to_replace=old_COMID, value=new_COMID)
-                tofroms["FROMCOMID"] = tofroms["FROMCOMID"].replace(to_replace=old_COMID, value=new_COMID)
+    # Get the list of waterbodies intersected by each river segment
+    river_comids = river_gdf.COMID.values
+    if edges is None:
+        lake_lists = list(river_gdf.lake_nodes.values)
+    else:
+        grouped    = edges.groupby("river_COMID", sort=False).lake_COMID.apply(list).to_dict()
+        lake_lists = [grouped.get(i, []) for i in river_comids]
+    
+    lake_comids = lake_gdf.COMID.values
+    lake_set    = set(lake_comids.tolist())
+
+    # If a river segment only intersects a single waterbody, then replace that river in the to-from list 
+    # with the waterbody COMID. Build a single map of all of these replacements and apply it once
+    single_map = dict()
+    for old_COMID, lakes in zip(river_comids, lake_lists):
+        if len(lakes) == 1 and lakes[0] in lake_set and old_COMID not in single_map:
+            single_map[old_COMID] = lakes[0]
+
+    from_values = _map_values(tofrom.FROMCOMID.values, single_map).tolist()
+    to_values   = _map_values(tofrom.TOCOMID.values, single_map).tolist()
+    source_rows = list(range(len(tofrom)))
+
+    # Rivers that intersect multiple waterbodies; the river segment is replaced by every waterbody it intersects
+    # that is not already in the to-from list. These waterbodies will not be directly connected to each other,
+    # but upstream and downstream connections outside of the waterbodies will be consistent
+    multi = [(old_COMID, lakes) for old_COMID, lakes in zip(river_comids, lake_lists) if len(lakes) > 1]
+
+    # Positions of each waterbody in lake_gdf; waterbodies are added in the order they appear in lake_gdf
+    lake_positions = dict()
+    for i, comid in enumerate(lake_comids.tolist()):
+        lake_positions.setdefault(comid, []).append(i)
+
+    # Index the rows of the to-from list that contain each multi-lake river or waterbody so that
+    # rows never have to be found by scanning the whole to-from list
+    tracked   = lake_set | {old_COMID for old_COMID, lakes in multi}
+    row_index = dict()
+
+    def index_row(p):
+        for value in {from_values[p], to_values[p]}:
+            if value in tracked:
+                row_index.setdefault(value, []).append(p)
+
+    if len(multi) > 0:
+        for p in range(len(source_rows)):
+            index_row(p)
+
+    for old_COMID, lakes in multi:
+
+        # Get the waterbodies intersected by the river segment that have not already been added to the to-from list
+        positions = sorted(p for comid in set(lakes) for p in lake_positions.get(comid, []))
+        lake_comids_to_add = [lake_comids[p] for p in positions if len(row_index.get(lake_comids[p], [])) == 0]
+        length = len(lake_comids_to_add)
+
+        # Rows of the to-from list that contain the river segment
+        old_rows = sorted(row_index.get(old_COMID, []))
+
+        # For every waterbody except the last, add a copy of the river segment's rows with the river 
+        # segment COMID replaced by the waterbody COMID
+        for j in range(length - 1):
+            new_COMID = lake_comids_to_add[j]
+            for p in old_rows:
+                source_rows.append(source_rows[p])
+                from_values.append(new_COMID if from_values[p] == old_COMID else from_values[p])
+                to_values.append(new_COMID if to_values[p] == old_COMID else to_values[p])
+                index_row(len(source_rows) - 1)
+
+        # Replace the river segment COMID with the final waterbody COMID
+        if length > 0:
+            new_COMID = lake_comids_to_add[length - 1]
+            for p in old_rows:
+                if from_values[p] == old_COMID:
+                    from_values[p] = new_COMID
+                if to_values[p] == old_COMID:
+                    to_values[p] = new_COMID
+                row_index.setdefault(new_COMID, []).append(p)
+            row_index[old_COMID] = []
+
+    # Build the new to-from list in a single step; the copied rows are placed after the original rows
+    tofroms = tofrom.iloc[source_rows].copy(deep=True)
+    tofroms["FROMCOMID"] = np.asarray(from_values).astype(tofrom.FROMCOMID.dtype)
+    tofroms["TOCOMID"]   = np.asarray(to_values).astype(tofrom.TOCOMID.dtype)
 
     # Reset the index; indices are now off because we have added new lines to the to-from list
     tofroms = tofroms.reset_index(drop=True)
-    
-    # Uncomment the two lines below to get the number of waterbodies that are impacted by the second for loop
-    #print("The number of affected lakes is")
-    #print(len(np.unique(lake_list_applied)))
 
     # Return the new to-from COMID list
     return tofroms
 
-def remove_river_nodes(tofrom, river_gdf, lake_gdf):
+def _contract_river_nodes(tofroms, river_gdf, lake_gdf, one_pass=False):
     """
-    Aggregate river nodes together if they fulfill certain criteria. 
+    Engine for aggregating river nodes in the to-from list. The merge rules are the rules of the 
+    original remove_river_nodes function, applied row by row to the to-from list. Rather than 
+    rewriting the whole to-from list every time two nodes are merged, merged nodes are tracked with 
+    a disjoint-set (union-find) structure, and the upstream/downstream neighbors of each node are 
+    found from adjacency lists of the to-from rows that are merged along with the nodes. 
+
+    If one_pass is True, the to-from list is passed over once. Otherwise, rows that connect a node to 
+    itself are removed after each pass, and passes are repeated until the number of nodes no longer
+    changes (the same stopping rule as aggregate_river_nodes). 
+
+    Returns the positions of the remaining to-from rows, the aggregated FROMCOMID and TOCOMID values
+    of these rows, and a dictionary mapping each original COMID to the COMID of its aggregated node
     """
-    
-    # Make a copy of the to-froms list
-    tofroms = tofrom.copy(deep=True)
-    
-    # Make a list of all waterbody COMIDs
-    lake_list = [i for i in lake_gdf.COMID.values]
-    # Iterate through the to-from list
-    for i in tqdm(range(len(tofroms))):
-        # Identify the to and from nodes based on TOCOMID and FROMCOMID
-        to_node    = tofroms.TOCOMID.values[i]
-        from_node  = tofroms.FROMCOMID.values[i]
-
-        # Skip iteration if the to node and from node are identical
-        if to_node == from_node:
-            continue
-    
-        # Test if both the to and from nodes are both lakes; if so, skip the iteration
-        if np.isin(to_node,lake_list) and np.isin(from_node,lake_list):
-            continue
-            
-        # If both the to and from nodes are not in the lake list, test if the from node is in the lake list
-        # If this statement is true, then the from_node is a waterbody and the to_node is a river
-        elif np.isin(from_node, lake_list):
 
-            # Get the list of all immediate upstream nodes to the to_node river segment
-            list_of_froms = list(np.unique(tofroms.FROMCOMID.values[tofroms.TOCOMID == to_node]))
+    n_rows = len(tofroms)
+
+    # Give every COMID in the to-from list an integer id; any missing values are given their own id
+    values = np.concatenate([tofroms.FROMCOMID.values, tofroms.TOCOMID.values])
+    codes, uniques = pd.factorize(values)
+    missing = np.flatnonzero(codes == -1)
+    codes[missing] = len(uniques) + np.arange(len(missing))
+    n_ids = len(uniques) + len(missing)
+
+    frm = codes[:n_rows].tolist()
+    to  = codes[n_rows:].tolist()
+
+    # Identify which ids are waterbodies, and get the HUC12 code of each id as a river and as a waterbody
+    # HUC12 codes are None if the id is not in the river or waterbody GeoDataFrame
+    def huc_list(gdf):
+        hucs = gdf.drop_duplicates("COMID").set_index("COMID").huc12
+        hucs = hucs.reindex(uniques).astype(object).tolist() + [None] * len(missing)
+        return [None if pd.isna(i) else i for i in hucs]
+
+    is_lake   = pd.Index(uniques).isin(lake_gdf.COMID.values).tolist() + [False] * len(missing)
+    river_huc = huc_list(river_gdf)
+    lake_huc  = huc_list(lake_gdf)
+
+    # Disjoint-set structure; label gives the id whose COMID is used for each set of merged nodes
+    parent = list(range(n_ids))
+    size   = [1] * n_ids
+    label  = list(range(n_ids))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Adjacency lists of to-from rows for each set of merged nodes
+    in_rows  = [[] for i in range(n_ids)]
+    out_rows = [[] for i in range(n_ids)]
+
+    def merge(old, new):
+        # Replace the node old with the node new (i.e., every to-from row containing old now contains new)
+        # old and new are the roots of their sets; returns the root of the merged set
+        if old == new:
+            return new
+        keep_label = label[new]
+        if size[old] > size[new]:
+            old, new = new, old
+        parent[old] = new
+        size[new]  += size[old]
+        label[new]  = keep_label
+        in_rows[new].extend(in_rows[old])
+        out_rows[new].extend(out_rows[old])
+        in_rows[old]  = []
+        out_rows[old] = []
+        return new
+
+    def froms_of(node):
+        return {find(frm[q]) for q in in_rows[node]}
+
+    def tos_of(node):
+        return {find(to[q]) for q in out_rows[node]}
+
+    rows   = list(range(n_rows))
+    x      = -1
+    y      = 0
+    passes = 0
+
+    while y != x:
+        x = y
 
-            # If the to_node is in the list_of_froms, remove it
-            if to_node in list_of_froms:
-                list_of_froms.remove(to_node)
+        # Build the adjacency lists for the rows in this pass
+        for i in range(n_ids):
+            in_rows[i]  = []
+            out_rows[i] = []
+        for r in rows:
+            in_rows[find(to[r])].append(r)
+            out_rows[find(frm[r])].append(r)
+
+        for r in tqdm(rows):
+            # Identify the to and from nodes of the row
+            to_node   = find(to[r])
+            from_node = find(frm[r])
+
+            # Skip iteration if the to node and from node are identical
+            if to_node == from_node:
+                continue
+
+            to_lake   = is_lake[label[to_node]]
+            from_lake = is_lake[label[from_node]]
+
+            # Test if both the to and from nodes are both lakes; if so, skip the iteration
+            if to_lake and from_lake:
+                continue
+
+            # If the from_node is a waterbody and the to_node is a river, aggregate the river node with the 
+            # waterbody if the waterbody is the river's only immediate upstream node and they are in the same HUC12
+            elif from_lake:
+                list_of_froms = froms_of(to_node)
+                list_of_froms.discard(to_node)
+
+                if list_of_froms == {from_node}:
+                    to_HUC   = river_huc[label[to_node]]
+                    from_HUC = lake_huc[label[from_node]]
+
+                    if to_HUC is not None and to_HUC == from_HUC:
+                        merge(to_node, from_node)
+
+            # If the to_node is a waterbody and the from_node is a river, aggregate the river node with the 
+            # waterbody if the waterbody is the river's only immediate downstream node and they are in the same HUC12
+            elif to_lake:
+                list_of_tos = tos_of(from_node)
+                list_of_tos.discard(from_node)
+
+                if list_of_tos == {to_node}:
+                    to_HUC   = lake_huc[label[to_node]]
+                    from_HUC = river_huc[label[from_node]]
+
+                    if to_HUC is not None and to_HUC == from_HUC:
+                        merge(from_node, to_node)
+
+            # If both the to and from nodes are not lakes, then they must both be river nodes
+            else:
+                list_of_froms = froms_of(to_node)
+
+                # If the to_node has several immediate upstream nodes, aggregate all of them with the to_node, 
+                # unless any of them flow into more than one node or are waterbodies, or the nodes are not all
+                # in the same HUC12
+                if len(list_of_froms) > 1:
+                    if any(len(tos_of(k)) > 1 for k in list_of_froms):
+                        continue
+                    if any(is_lake[label[k]] for k in list_of_froms):
+                        continue
+
+                    all_hucs = {river_huc[label[to_node]]} | {river_huc[label[k]] for k in list_of_froms}
+
+                    if len(all_hucs) == 1 and None not in all_hucs:
+                        for k in list_of_froms:
+                            to_node = merge(k, to_node)
+
+                # If the from_node is the only immediate upstream node, aggregate the from_node into the to_node
+                # if they are in the same HUC12
+                else:
+                    to_HUC   = river_huc[label[to_node]]
+                    from_HUC = river_huc[label[from_node]]
+
+                    if to_HUC is not None and to_HUC == from_HUC:
+                        merge(from_node, to_node)
+
+        passes += 1
+        if one_pass:
+            break
+
+        # Remove rows that now connect a node to itself, and count the remaining nodes
+        rows = [r for r in rows if find(frm[r]) != find(to[r])]
+        y    = len({find(frm[r]) for r in rows} | {find(to[r]) for r in rows})
+        
+        if passes > 1:
+            print("new number of nodes = ", y)
+            print("old number of nodes = ", x)
+            if y - x != 0:
+                print("Running another iteration")
+                print("number of nodes changed")
+                print()
 
-            # Get the list of all immediate downstream nodes to the to_node river segment
-            list_of_tos = list(np.unique(tofroms.TOCOMID.values[tofroms.FROMCOMID == to_node]))
+    # Get the aggregated COMID of every id
+    comids = list(uniques) + [np.nan] * len(missing)
+    rep    = [label[find(i)] for i in range(n_ids)]
 
-            # If the to_node is in the list_of_tos, remove it
-            if to_node in list_of_tos:
-                list_of_tos.remove(to_node)
-            
-            # If there is only one value in the list_of_froms, then that upstream node is the from_node waterbody
-            # We then will replace the to_node in the to-froms list with the from_node (i.e., we aggregate the 
-            # river node with the waterbody from_node). This only occurs if the two nodes are in the same watershed
-            if len(list_of_froms) == 1 and list_of_froms[0] == from_node:
-
-                # Identify the HUC12 code for both the to and from node
-                to_HUC   = river_gdf.huc12.values[river_gdf.COMID == to_node]
-                from_HUC = lake_gdf.huc12.values[lake_gdf.COMID == from_node]
-                
-                # If the to and from nodes are in the same HUC12, replace the to_node river segment with the waterbody node
-                if to_HUC == from_HUC:
-                    tofroms["FROMCOMID"] = tofroms["FROMCOMID"].replace(to_replace=to_node, value=from_node)
-                    tofroms["TOCOMID"]   = tofroms["TOCOMID"].replace(to_replace=to_node, value=from_node)
-                    
-
-        # If both the to and from nodes are not in the lake list, test if the to node is in the lake list
-        # If this statement is true, then the to_node is a waterbody and the from_node is a river 
-        elif np.isin(to_node, lake_list):
-
-            # Get the list of all immediate upstream nodes to the from_node river segment
-            list_of_froms = list(np.unique(tofroms.FROMCOMID.values[tofroms.TOCOMID == from_node]))
-
-            # If the from_node is in the list_of_froms, remove it
-            if from_node in list_of_froms:
-                list_of_froms.remove(from_node)
-            
-            # Get the list of all immediate downstream nodes to the from_node river segment
-            list_of_tos = list(np.unique(tofroms.TOCOMID.values[tofroms.FROMCOMID == from_node]))
+    from_values = [comids[rep[frm[r]]] for r in rows]
+    to_values   = [comids[rep[to[r]]] for r in rows]
+    node_map    = {comids[i]: comids[rep[i]] for i in range(len(uniques))}
 
-            # If the from_node is in the list_of_tos, remove it
-            if from_node in list_of_tos:
-                list_of_tos.remove(from_node)
+    return rows, from_values, to_values, node_map
 
-            # If there is only one value in the list_of_tos, then that downstream node is the to_node waterbody
-            # We then will replace the from_node in the to-froms list with the to_node (i.e., we aggregate the 
-            # river node with the waterbody to_node). This only occurs if the two nodes are in the same watershed
-            if len(list_of_tos) == 1 and list_of_tos[0] == to_node:
-                
-                # Identify the HUC12 code for both the to and from node
-                to_HUC   = lake_gdf.huc12.values[lake_gdf.COMID == to_node][0]
-                from_HUC = river_gdf.huc12.values[river_gdf.COMID == from_node][0]
-                
-                # If the to and from nodes are in the same HUC12, replace the from_node river segment with the waterbody node
-                if to_HUC == from_HUC:
-                    tofroms["FROMCOMID"] = tofroms["FROMCOMID"].replace(to_replace=from_node, value=to_node)
-                    tofroms["TOCOMID"]   = tofroms["TOCOMID"].replace(to_replace=from_node, value=to_node)
-    
-        # If both the to and from nodes are not lakes, then they must both be river nodes
-        # We will then aggregate the river nodes if certain criteria are met
-        else:
-            
-            # Get the list of nodes connected to the to_node river segment
-            list_of_froms = list(np.unique(tofroms.FROMCOMID.values[tofroms.TOCOMID == to_node]))
-            
-            # If the list_of_froms has more than one value in it, then we will run further tests
-            if len(list_of_froms) > 1:
-                
-                # Define an indicator. If certain criteria are met, we set this indicator to 1 and exit the loop
-                indicator = 0
-
-                # Iterate through the list of froms
-                for k in list_of_froms:
-
-                    # If the from nodes flow into more than one to_node, then we will not do any aggregation
-                    # by setting the indicator to 1. This prevents us from aggregating a downstream node farther upstream
-                    # and thus creating connections downstream that don't exist if we run this funciton again
-                    if len(list(np.unique(tofroms.TOCOMID.values[tofroms.FROMCOMID == k]))) > 1:
-                        indicator = 1
-                # If the to_node is connected has an immediate upstream connection to a lake, set indicator to 1.
-                # This prevents us from moving a lake downstream and creating connections that don't exist if we call the function again
-                if  len(lake_gdf[lake_gdf.COMID.isin(list_of_froms)]) > 0:
-                    indicator = 1
-                
-                # If we have set the indicator to 1, skip this iteration. Otherwise, continue to the else statement
-                if indicator == 1:
-                    continue
-
-                # Test to make sure that all nodes to be aggregated are in the same HUC12. If not, we will not aggregate
-                else: 
-
-                    # Identify the HUC12 of the to_node
-                    to_huc = river_gdf.huc12.values[river_gdf.COMID == to_node][0]
-
-                    # Make a list to put all HUC12 values into
-                    all_hucs = [to_huc]
-
-                    # Iterate through all the list_of_froms and add their HUC12 to the list
-                    for k in list_of_froms:
-                        from_huc = river_gdf.huc12.values[river_gdf.COMID == k][0]
-                        all_hucs = np.append(all_hucs, from_huc)
-                    
-                    # If all the potentially aggregated nodes are in the same HUC12, aggregate
-                    # Note that we are aggregating all immediate upstream nodes with the to_node Because of our tests above,
-                    # none of these 
-                    if len(np.unique(all_hucs)) == 1:
-                        for k in list_of_froms:                    
-                            tofroms["FROMCOMID"] = tofroms["FROMCOMID"].replace(to_replace=k, value=to_node)
-                            tofroms["TOCOMID"]   = tofroms["TOCOMID"].replace(to_replace=k, value=to_node)
-                
-            # If the list_of_froms is only length 1, then we will aggregate the from node into the two node if they are in the same HUC12
-            else:
+def _contracted_tofroms(tofroms, rows, from_values, to_values):
+    """
+    Build the aggregated to-from list from the output of _contract_river_nodes
+    """
 
-                # Identify HUC12 codes for each river node
-                to_HUC   = river_gdf.huc12.values[river_gdf.COMID == to_node][0]
-                from_HUC = river_gdf.huc12.values[river_gdf.COMID == from_node][0]
-                
-                # If the river nodes are in the same HUC12, then aggregate
-                if to_HUC == from_HUC:
-                    tofroms["FROMCOMID"] = tofroms["FROMCOMID"].replace(to_replace=from_node, value=to_node)
-                    tofroms["TOCOMID"]   = tofroms["TOCOMID"].replace(to_replace=from_node, value=to_node)
-                
-                
-    tofroms = tofroms.reset_index(drop=True)
-    return tofroms.copy(deep=True)
+    new_tofroms = tofroms.iloc[rows].copy(deep=True).reset_index(drop=True)
+    new_tofroms["FROMCOMID"] = pd.Series(from_values, dtype=object).astype(tofroms.FROMCOMID.dtype).values
+    new_tofroms["TOCOMID"]   = pd.Series(to_values, dtype=object).astype(tofroms.TOCOMID.dtype).values
+
+    return new_tofroms
+
+def remove_river_nodes(tofrom, river_gdf, lake_gdf):
+    """
+    Aggregate river nodes together if they fulfill certain criteria. 
+
+    This makes one pass over the to-from list (see _contract_river_nodes for the criteria). Rows 
+    of the returned to-from list may have identical TOCOMID and FROMCOMID values; these can be
+    removed with remove_tofrom_duplicates
+    """
+
+    rows, from_values, to_values, node_map = _contract_river_nodes(tofrom, river_gdf, lake_gdf, one_pass=True)
+
+    return _contracted_tofroms(tofrom, rows, from_values, to_values)
 
 def remove_tofrom_duplicates(tofroms):
     """
     Removes lines of the to-from list that contain the same TOCOMID and FROMCOMID value
     """
 
-    # Make a copy of the tofroms list
-    tofroms_copy = tofroms.copy(deep=True)
-    
-    # Iterate through the list
-    # If the TOCOMID is the same as the FROMCOMID, drop that line
-    for i in tqdm(range(len(tofroms))):
-        if tofroms.TOCOMID.iloc[i] == tofroms.FROMCOMID.iloc[i]:
-            tofroms_copy = tofroms_copy.drop(tofroms.index[i])
-            
     # Return shortened to-from list
-    return tofroms_copy.copy(deep=True)
+    return tofroms[tofroms.TOCOMID != tofroms.FROMCOMID].copy(deep=True)
 
-def aggregate_river_nodes(tofroms, river_gdf, lake_gdf):
+def contract_river_nodes(tofroms, river_gdf, lake_gdf):
     """
     Aggregate river nodes from the to-from list. This function will remove several river nodes
     from the graph. However, it does not remove any waterbody nodes, and it does not merge any 
     nodes that lie in different watersheds
+
+    Returns the aggregated to-from list and a dictionary mapping every COMID in the original to-from
+    list to the COMID of the node it was aggregated into
     """
 
-    # Run the function remove_river_nodes and then remove the duplicates from the resulting to-from list
-    tofroms = remove_river_nodes(tofroms.copy(), river_gdf.copy(), lake_gdf.copy())
-    tofroms = remove_tofrom_duplicates(tofroms.copy())
-    
-    
-    # Build a graph from the aggregated to from list
-    G = build_graph(tofroms)
-    
-    # Define variables to determine if the aggregation change the graph at all. We will aggregate
-    # nodes until there is no longer any change happening between calls of the aggregate function
-    x = 0
-    y = len([i for i in G.nodes])
-    
-    # While there is a change between calls to the aggregate (remove_river_nodes) function, then 
-    # keep running the loop
-    while y - x != 0:
-        x = y
+    rows, from_values, to_values, node_map = _contract_river_nodes(tofroms, river_gdf, lake_gdf)
 
-        # Run the function remove_river_nodes and then remove the duplicates from teh resulting to-from list
-        # This function aggregates river nodes together
-        tofroms = remove_river_nodes(tofroms.copy(), river_gdf.copy(), lake_gdf.copy())
-        tofroms = remove_tofrom_duplicates(tofroms.copy())
+    return _contracted_tofroms(tofroms, rows, from_values, to_values), node_map
+
+def aggregate_river_nodes(tofroms, river_gdf, lake_gdf):
+    """
+    Aggregate river nodes from the to-from list. This function will remove several river nodes
+    from the graph. However, it does not remove any waterbody nodes, and it does not merge any 
+    nodes that lie in different watersheds
+
+    Nodes are aggregated until there is no longer any change in the number of nodes. Use 
+    contract_river_nodes to also get the mapping of the original nodes to the aggregated nodes
+    """
 
-        # Build the new graph to determine the number of nodes it now has
-        G = build_graph(tofroms)
-        
-        # If the number of nodes before and after aggregation changes, rerun this loop
-        y = len([i for i in G.nodes])
-        print("new number of nodes = ", y)
-        print("old number of nodes = ", x)
-        if y - x != 0:
-            print("Running another iteration")
-            print("number of nodes changed")
-            print()
-        
     # Return aggregate to-from list
-    return tofroms
+    return contract_river_nodes(tofroms, river_gdf, lake_gdf)[0]
 
 def build_graph(tofroms):
     """
     Builds a directed graph network from the to-froms list
     """
 
-    # Define the directed graph using NetworkX
-    G = nx.DiGraph()
+    # Define the from nodes and to nodes based on to-from list
+    from_nodes = tofroms.FROMCOMID.values
+    to_nodes   = tofroms.TOCOMID.values
+    
+    # If the TOCOMID and FROMCOMID are different, add a new edge to the graph
+    # Adding the edges also adds nodes to the graph in the order they appear in the to-from list
+    keep = from_nodes != to_nodes
 
-    # Iterate through to-froms
-    for j in range(len(tofroms)):
-        
-        # Define the from node and to node based on to-from list
-        from_node = tofroms.FROMCOMID.iloc[j]
-        to_node   = tofroms.TOCOMID.iloc[j]
-        
-        # If the TOCOMID and FROMCOMID are different, add a new edge to the graph
-        # Adding the edge also adds nodes to the graph that were not previously defined
-        if from_node != to_node:
-            G.add_edge(from_node, to_node)
+    # Define the directed graph using NetworkX, and add all edges in a single call
+    G = nx.DiGraph()
+    G.add_edges_from(zip(from_nodes[keep].tolist(), to_nodes[keep].tolist()))
 
     # Return the directed graph
     return G
 
-def get_pos_dict(G, lake_gdf, riv_gdf, n_size = 10,lake_color="blue", river_color="red"):
+def _csr_neighbors(indptr, indices, nodes):
+    """
+    Return the neighbors of all the given nodes of a CSR graph as a single array
+    """
+
+    starts  = indptr[nodes]
+    lengths = indptr[np.asarray(nodes) + 1] - starts
+    total   = lengths.sum()
+
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Build the positions of the neighbors in indices without looping over the nodes
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+    return indices[offsets + np.arange(total)]
+
+def _label_array(labels):
+    """
+    Convert a list of node labels to an array. Numeric labels (COMIDs) give a numeric array; any other
+    labels (e.g., names of pollutant sources) give an object array
+    """
+
+    labels = list(labels)
+    array  = np.asarray(labels)
+
+    if array.dtype.kind not in "iuf":
+        array = np.empty(len(labels), dtype=object)
+        array[:] = labels
+
+    return array
+
+class CSRGraph:
+    """
+    Compact directed graph stored in NumPy arrays, used for fast traversal of large river networks.
+    Nodes are given the integer ids 0, ..., n-1, and the node labels (COMIDs) are stored in the array 
+    nodes. The downstream nodes of node i are indices[indptr[i]:indptr[i+1]] and the upstream nodes of
+    node i are rindices[rindptr[i]:rindptr[i+1]]
+
+    Build with CSRGraph.from_tofroms, CSRGraph.from_edges, or CSRGraph.from_networkx, and convert back
+    to a networkx DiGraph with to_networkx (e.g., for plotting). Node and edge order are the same as 
+    those of the networkx graph built from the same edges
+    """
+
+    def __init__(self, nodes, indptr, indices):
+
+        self.nodes   = np.asarray(nodes)
+        self.indptr  = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.index   = pd.Index(self.nodes)
+
+        # Build the reverse (upstream) adjacency arrays by sorting the edges by their downstream node
+        n       = len(self.nodes)
+        sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+        order   = np.argsort(self.indices, kind="stable")
+
+        self.rindices = sources[order]
+        self.rindptr  = np.concatenate([[0], np.cumsum(np.bincount(self.indices, minlength=n))]).astype(np.int64)
+
+    @classmethod
+    def from_edges(cls, from_nodes, to_nodes):
+        """
+        Build the graph from arrays of from nodes and to nodes. Edges from a node to itself, repeated
+        edges, and edges with missing nodes are not added, as in build_graph
+        """
+
+        from_nodes = np.asarray(from_nodes)
+        to_nodes   = np.asarray(to_nodes)
+
+        keep = (from_nodes != to_nodes) & pd.notna(from_nodes) & pd.notna(to_nodes)
+        from_nodes = from_nodes[keep]
+        to_nodes   = to_nodes[keep]
+
+        # Give the nodes integer ids in the order they first appear in the edge list
+        stacked = np.empty(2 * len(from_nodes), dtype=np.result_type(from_nodes, to_nodes))
+        stacked[0::2] = from_nodes
+        stacked[1::2] = to_nodes
+        codes, nodes = pd.factorize(stacked)
+        n = len(nodes)
+
+        u = codes[0::2].astype(np.int64)
+        v = codes[1::2].astype(np.int64)
+
+        # Remove repeated edges, keeping the first occurrence of each edge
+        _, first = np.unique(u * n + v, return_index=True)
+        first = np.sort(first)
+        u, v  = u[first], v[first]
+
+        # Sort the edges by from node; the sort is stable, so edges keep their order for each node
+        order   = np.argsort(u, kind="stable")
+        indptr  = np.concatenate([[0], np.cumsum(np.bincount(u, minlength=n))])
+
+        return cls(np.asarray(nodes), indptr, v[order])
+
+    @classmethod
+    def from_tofroms(cls, tofroms):
+        """
+        Build the graph from the to-froms list
+        """
+
+        return cls.from_edges(tofroms.FROMCOMID.values, tofroms.TOCOMID.values)
+
+    @classmethod
+    def from_networkx(cls, G):
+        """
+        Build the graph from a networkx directed graph
+        """
+
+        nodes = _label_array(G.nodes)
+        index = pd.Index(nodes)
+        edges = list(G.edges)
+        u = index.get_indexer([i[0] for i in edges]).astype(np.int64)
+        v = index.get_indexer([i[1] for i in edges]).astype(np.int64)
+
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(u, minlength=len(nodes)))])
+
+        return cls(nodes, indptr, v)
+
+    def to_networkx(self):
+        """
+        Convert the graph to a networkx directed graph
+        """
+
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+
+        G = nx.DiGraph()
+        G.add_nodes_from(self.nodes.tolist())
+        G.add_edges_from(zip(self.nodes[sources].tolist(), self.nodes[self.indices].tolist()))
+
+        return G
+
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def node_ids(self, labels):
+        """
+        Return the integer ids of the given node labels (COMIDs)
+        """
+
+        ids = self.index.get_indexer(np.atleast_1d(labels))
+        if (ids < 0).any():
+            raise KeyError("Nodes are not in the graph: " + str(list(np.atleast_1d(labels)[ids < 0])))
+
+        return ids
+
+    def successors(self, node):
+        """
+        Return the labels of the immediate downstream nodes of node
+        """
+
+        i = self.node_ids(node)[0]
+        return self.nodes[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def predecessors(self, node):
+        """
+        Return the labels of the immediate upstream nodes of node
+        """
+
+        i = self.node_ids(node)[0]
+        return self.nodes[self.rindices[self.rindptr[i]:self.rindptr[i + 1]]]
+
+    def reachable(self, ids, reverse=False):
+        """
+        Return a boolean array marking all nodes that can be reached from the nodes with the given 
+        integer ids (including the nodes themselves). If reverse is True, edges are followed upstream
+        """
+
+        indptr, indices = (self.rindptr, self.rindices) if reverse else (self.indptr, self.indices)
+
+        seen = np.zeros(len(self.nodes), dtype=bool)
+        frontier = np.unique(np.atleast_1d(ids))
+        seen[frontier] = True
+
+        # Breadth first search, visiting a whole frontier of nodes at once
+        while len(frontier) > 0:
+            neighbors = _csr_neighbors(indptr, indices, frontier)
+            neighbors = np.unique(neighbors[~seen[neighbors]])
+            seen[neighbors] = True
+            frontier = neighbors
+
+        return seen
+
+    def upstream_nodes(self, node):
+        """
+        Return the labels of all nodes upstream of node, including node
+        """
+
+        return self.nodes[self.reachable(self.node_ids(node), reverse=True)]
+
+    def downstream_nodes(self, node):
+        """
+        Return the labels of all nodes downstream of node, including node
+        """
+
+        return self.nodes[self.reachable(self.node_ids(node))]
+
+def _topological_levels(indptr, indices, n):
+    """
+    Return the level of every node of a directed acyclic graph given by CSR arrays. Nodes with no 
+    incoming edges have level 0, and every other node has a level one greater than the highest level
+    of the nodes with edges into it (i.e., the length of the longest path reaching the node). 
+    Nodes are visited a whole level at a time
+    """
+
+    remaining = np.bincount(indices, minlength=n)
+    level     = np.full(n, -1, dtype=np.int64)
+    frontier  = np.flatnonzero(remaining == 0)
+    L = 0
+
+    while len(frontier) > 0:
+        level[frontier] = L
+
+        # Remove the edges leaving the frontier; nodes with no remaining incoming edges form the next frontier
+        neighbors, counts = np.unique(_csr_neighbors(indptr, indices, frontier), return_counts=True)
+        remaining[neighbors] -= counts
+        frontier = neighbors[remaining[neighbors] == 0]
+        L += 1
+
+    if (level < 0).any():
+        raise ValueError("Graph contains a cycle; levels are only defined for acyclic graphs")
+
+    return level
+
+def _edge_csr(u, v, n):
+    """
+    Return the CSR arrays (indptr, indices) of the directed graph with n nodes and edges u -> v
+    """
+
+    order  = np.argsort(u, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(u, minlength=n))]).astype(np.int64)
+
+    return indptr, np.asarray(v, dtype=np.int64)[order]
+
+class ReachabilityIndex:
+    """
+    Precomputed index for upstream and downstream queries on a river network. G can be a networkx
+    DiGraph or a CSRGraph. 
+
+    The graph is condensed into its strongly connected components (so that graphs containing cycles
+    can also be indexed), and the components are put into topological order. Single queries (e.g., 
+    upstream_nodes or upstream_graph) traverse the CSR arrays of the graph a whole frontier at a time, 
+    so they take time proportional to the size of the answer. Batched queries (upstream_sets and 
+    downstream_sets) compute the answers for many nodes at once with bitset labels, which are propagated
+    through the components in a single sweep in topological order
+    """
+
+    def __init__(self, G):
+
+        self.graph = G if isinstance(G, CSRGraph) else CSRGraph.from_networkx(G)
+        graph = self.graph
+        n     = graph.number_of_nodes()
+
+        # Condense the strongly connected components of the graph into single nodes
+        adjacency = csr_matrix((np.ones(len(graph.indices), dtype=np.int8), graph.indices, graph.indptr), shape=(n, n))
+        n_comp, component = connected_components(adjacency, directed=True, connection="strong")
+        self.component = component.astype(np.int64)
+
+        sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(graph.indptr))
+        comp_u  = self.component[sources]
+        comp_v  = self.component[graph.indices]
+        between = comp_u != comp_v
+
+        self.n_components = n_comp
+
+        # Edges of the condensed graph, as arrays of upstream and downstream component ids
+        keep = np.unique(comp_u[between] * n_comp + comp_v[between])
+        self.comp_edges = (keep // n_comp, keep % n_comp)
+
+        # Depth is the length of the longest path into a component from the top of the network, and 
+        # height is the length of the longest path from a component to the bottom of the network
+        u, v = self.comp_edges
+        self.depth  = _topological_levels(*_edge_csr(u, v, n_comp), n_comp)
+        self.height = _topological_levels(*_edge_csr(v, u, n_comp), n_comp)
+
+    def upstream_mask(self, node):
+        """
+        Return a boolean array over the nodes of the graph marking all nodes upstream of node (including node)
+        """
+
+        return self.graph.reachable(self.graph.node_ids(node), reverse=True)
+
+    def downstream_mask(self, node):
+        """
+        Return a boolean array over the nodes of the graph marking all nodes downstream of node (including node)
+        """
+
+        return self.graph.reachable(self.graph.node_ids(node))
+
+    def upstream_nodes(self, node):
+        """
+        Return the labels (COMIDs) of all nodes upstream of node, including node
+        """
+
+        return self.graph.nodes[self.upstream_mask(node)]
+
+    def downstream_nodes(self, node):
+        """
+        Return the labels (COMIDs) of all nodes downstream of node, including node
+        """
+
+        return self.graph.nodes[self.downstream_mask(node)]
+
+    def _induced_graph(self, node, mask):
+        # Build the networkx graph induced by the nodes in mask, using only the edges leaving those nodes
+        graph = self.graph
+        ids   = np.flatnonzero(mask)
+
+        u = np.repeat(ids, graph.indptr[ids + 1] - graph.indptr[ids])
+        v = _csr_neighbors(graph.indptr, graph.indices, ids)
+        inside = mask[v]
+
+        subG = nx.DiGraph()
+        subG.add_node(node)
+        subG.add_nodes_from(graph.nodes[ids].tolist())
+        subG.add_edges_from(zip(graph.nodes[u[inside]].tolist(), graph.nodes[v[inside]].tolist()))
+
+        return subG
+
+    def upstream_graph(self, node):
+        """
+        Return the networkx graph induced by all nodes upstream of node (the same graph as get_upstream_graph)
+        """
+
+        return self._induced_graph(node, self.upstream_mask(node))
+
+    def downstream_graph(self, node):
+        """
+        Return the networkx graph induced by all nodes downstream of node (the same graph as get_downstream_graph)
+        """
+
+        return self._induced_graph(node, self.downstream_mask(node))
+
+    def _labels(self, ids, upstream):
+        # Give every node in ids one bit in a bitset label of every component. Labels are propagated 
+        # through the condensed graph in topological order; a component's label is the bitwise OR of its 
+        # own bits and the labels of the components downstream (upstream) of it
+        n_words = max(1, (len(ids) + 63) // 64)
+
+        labels = np.zeros((self.n_components, n_words), dtype=np.uint64)
+        bits   = np.arange(len(ids))
+        np.bitwise_or.at(labels, (self.component[ids], bits // 64), np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+
+        u, v = self.comp_edges
+        if upstream:
+            # A component is upstream of a queried node if any component downstream of it is
+            order_level, targets, from_comps = self.height, u, v
+        else:
+            order_level, targets, from_comps = self.depth, v, u
+
+        # Group the edges by the level of the component receiving the label, and sweep the levels in order
+        edge_level = order_level[targets]
+        order      = np.argsort(edge_level, kind="stable")
+        targets, from_comps, edge_level = targets[order], from_comps[order], edge_level[order]
+        bounds = np.searchsorted(edge_level, np.arange(edge_level.max() + 2)) if len(edge_level) > 0 else [0]
+
+        for L in range(len(bounds) - 1):
+            a, b = bounds[L], bounds[L + 1]
+            if a < b:
+                np.bitwise_or.at(labels, targets[a:b], labels[from_comps[a:b]])
+
+        return labels
+
+    def _batched(self, nodes, upstream):
+        nodes = list(nodes)
+        ids   = self.graph.node_ids(nodes) if len(nodes) > 0 else np.zeros(0, dtype=np.int64)
+
+        # Unpack the labels into the set of nodes for each queried node
+        node_labels = self._labels(ids, upstream)[self.component]
+        result = dict()
+        for k, node in enumerate(nodes):
+            has_bit = (node_labels[:, k // 64] >> np.uint64(k % 64)) & np.uint64(1)
+            result[node] = self.graph.nodes[has_bit.astype(bool)]
+
+        return result
+
+    def upstream_sets(self, nodes):
+        """
+        Return a dictionary giving the labels of all nodes upstream of each of the given nodes 
+        (including the node itself). All nodes are answered in a single sweep of the graph
+        """
+
+        return self._batched(nodes, upstream=True)
+
+    def downstream_sets(self, nodes):
+        """
+        Return a dictionary giving the labels of all nodes downstream of each of the given nodes 
+        (including the node itself). All nodes are answered in a single sweep of the graph
+        """
+
+        return self._batched(nodes, upstream=False)
+
+def accumulate_upstream(G, node_values, weight=None):
+    """
+    Compute the cumulative upstream total of one or more numeric attributes for every node of the 
+    graph in a single topological sweep. G can be a networkx DiGraph (e.g., from build_graph), a 
+    CSRGraph, or a ReachabilityIndex (in which case its condensation is reused). node_values is a 
+    Series or DataFrame indexed by node (COMID) giving the value of each node itself, such as catchment 
+    area, land-cover area, or point-source load; nodes without a value are given 0. A column of ones 
+    gives the number of upstream catchments
+
+    The total at a node is its own value plus everything delivered to it from upstream. When a node 
+    feeds more than one downstream node (e.g., a river that flows into more than one waterbody), its 
+    total is split between the downstream nodes, so nothing is counted twice further downstream. The 
+    split is equal unless weight is given, in which case it is proportional to the edge attribute weight
+    of the networkx graph (edges without the attribute have weight 1). Nodes in a cycle are treated as
+    a single node and share the same total
+
+    Returns a Series or DataFrame (matching node_values) of cumulative totals indexed by node
+    """
+
+    index = G if isinstance(G, ReachabilityIndex) else ReachabilityIndex(G)
+    graph = index.graph
+    n     = graph.number_of_nodes()
+
+    values = node_values.to_frame() if isinstance(node_values, pd.Series) else node_values
+    local  = values.reindex(graph.index).fillna(0).to_numpy(dtype=float)
+
+    # Sum the values of the nodes of each strongly connected component
+    totals = np.zeros((index.n_components, local.shape[1]))
+    np.add.at(totals, index.component, local)
+
+    # Get the edges between components, and the fraction of the upstream total carried by each edge
+    sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(graph.indptr))
+    comp_u  = index.component[sources]
+    comp_v  = index.component[graph.indices]
+
+    if weight is None:
+        edge_weight = np.ones(len(comp_u))
+    elif isinstance(G, nx.DiGraph):
+        # Edges of the CSRGraph are in the same order as the edges of the networkx graph
+        edge_weight = np.array([d for _, _, d in G.edges(data=weight, default=1.0)], dtype=float)
+    else:
+        raise ValueError("weight can only be used when G is a networkx DiGraph")
+
+    between = comp_u != comp_v
+    comp_u, comp_v, edge_weight = comp_u[between], comp_v[between], edge_weight[between]
+
+    weight_sum = np.zeros(index.n_components)
+    np.add.at(weight_sum, comp_u, edge_weight)
+    fraction = np.divide(edge_weight, weight_sum[comp_u], out=np.zeros(len(comp_u)), where=weight_sum[comp_u] > 0)
+
+    # Sweep through the components one level at a time. Every edge leaving a level ends at a deeper 
+    # level, so the totals of a level are complete before they are passed downstream
+    edge_level = index.depth[comp_u]
+    order      = np.argsort(edge_level, kind="stable")
+    comp_u, comp_v, fraction, edge_level = comp_u[order], comp_v[order], fraction[order], edge_level[order]
+    bounds = np.searchsorted(edge_level, np.arange(edge_level.max() + 2)) if len(edge_level) > 0 else [0]
+
+    for L in range(len(bounds) - 1):
+        a, b = bounds[L], bounds[L + 1]
+        if a < b:
+            np.add.at(totals, comp_v[a:b], totals[comp_u[a:b]] * fraction[a:b, None])
+
+    result = pd.DataFrame(totals[index.component], index=graph.index, columns=values.columns)
+
+    if isinstance(node_values, pd.Series):
+        return result.iloc[:, 0].rename(node_values.name)
+
+    return result
+
+def _label_bits(labels, n_bits):
+    """
+    Unpack bitset labels (rows of uint64 words, as built by ReachabilityIndex) into a boolean array 
+    with one column for each of the first n_bits bits
+    """
+
+    bits = np.unpackbits(labels.astype("<u8").view(np.uint8), axis=1, bitorder="little")
+    return bits[:, :n_bits].astype(bool)
+
+def _station_membership(index, stations):
+    """
+    Engine for station_subwatersheds. Returns a boolean array over the components of the index marking
+    the stations whose sub-watershed each component belongs to, and a boolean station x station array 
+    marking the stations immediately upstream of each station
+    """
+
+    n_stations = len(stations)
+    ids = index.graph.node_ids(stations) if n_stations > 0 else np.zeros(0, dtype=np.int64)
+
+    # For every component, the stations downstream of it (including a station in the component itself),
+    # found in a single sweep of the network
+    reach = _label_bits(index._labels(ids, upstream=True), n_stations)
+
+    # upstream[k, t] is True if station t is upstream of station k
+    upstream = reach[index.component[ids]].T.copy()
+    np.fill_diagonal(upstream, False)
+
+    # A station is immediately upstream of k if there is no other station between them
+    between   = (upstream.astype(np.int64) @ upstream.astype(np.int64)) > 0
+    immediate = upstream & ~between
+
+    # A component belongs to the sub-watershed of station k if k is downstream of it and none of the
+    # stations upstream of k are. Components with the same downstream stations are handled together
+    rows, inverse = np.unique(reach, axis=0, return_inverse=True)
+    blocked = (rows.astype(np.int64) @ upstream.T.astype(np.int64)) > 0
+    owners  = (rows & ~blocked)[inverse.ravel()]
+
+    return owners, immediate
+
+def station_subwatersheds(G, stations):
+    """
+    Find the sub-watershed of every station on the network. G can be a networkx DiGraph, a CSRGraph, 
+    or a ReachabilityIndex, and stations is a list of the nodes (COMIDs) that the stations lie on (e.g.,
+    the "node" column from StationLocator.snap). 
+
+    The sub-watershed of a station is the set of nodes upstream of the station (including the station's
+    node) that are not upstream of any other station upstream of it, as when the upstream graph of the 
+    nested upstream station is removed from the upstream graph of the station. All stations are found in
+    a single sweep of the network, rather than by building the upstream graph of every station. A node 
+    draining to several stations that are not upstream of each other (e.g., below a divergence) is in
+    the sub-watershed of each of them
+
+    Returns a dataframe with the columns "node" and "station" giving the station of every node in a
+    sub-watershed, and a dictionary giving the list of stations immediately upstream of each station
+    """
+
+    index    = G if isinstance(G, ReachabilityIndex) else ReachabilityIndex(G)
+    stations = list(dict.fromkeys(stations))
+
+    owners, immediate = _station_membership(index, stations)
+
+    node_ids, station_pos = np.nonzero(owners[index.component])
+    membership = pd.DataFrame({
+        "node":    index.graph.nodes[node_ids],
+        "station": np.asarray(stations, dtype=object)[station_pos] if len(stations) > 0 else [],
+    })
+    upstream = {station: [stations[t] for t in np.flatnonzero(immediate[k])] for k, station in enumerate(stations)}
+
+    return membership, upstream
+
+def nested_station_export(G, loads, node_values):
+    """
+    Compute the export of every station's sub-watershed (see station_subwatersheds) for all stations at 
+    once. loads is a dataframe indexed by station node (COMID) giving the total load measured at each 
+    station (e.g., one column of yearly TP export per year), and node_values is a Series or DataFrame 
+    indexed by node giving the area(s) of each node (e.g., catchment area and agricultural area); nodes
+    without a value are given 0
+
+    The incremental load of a station is its load minus the loads of the stations immediately upstream
+    of it, and its incremental area is the total area of the nodes in its sub-watershed. The export rate
+    is the incremental load divided by the incremental area
+
+    Returns a dataframe indexed by station with the column "upstream_stations" (the list of stations 
+    immediately upstream), the incremental area columns (named as in node_values), the incremental load
+    columns (named as in loads), and an export rate column named load + "_per_" + area for every load
+    and area column
+    """
+
+    index    = G if isinstance(G, ReachabilityIndex) else ReachabilityIndex(G)
+    graph    = index.graph
+    stations = list(loads.index)
+
+    if len(set(stations)) != len(stations):
+        raise ValueError("loads must have a single row for each station")
+
+    owners, immediate = _station_membership(index, stations)
+
+    # Sum the node values over the nodes of each sub-watershed
+    values = node_values.to_frame() if isinstance(node_values, pd.Series) else node_values
+    local  = values.reindex(graph.index).fillna(0).to_numpy(dtype=float)
+    node_ids, station_pos = np.nonzero(owners[index.component])
+
+    areas = np.zeros((len(stations), local.shape[1]))
+    np.add.at(areas, station_pos, local[node_ids])
+
+    # Subtract the loads of the stations immediately upstream of each station
+    totals = loads.to_numpy(dtype=float)
+    incremental = totals - immediate.astype(float) @ totals
+
+    table = pd.DataFrame(index=loads.index)
+    table["upstream_stations"] = [[stations[t] for t in np.flatnonzero(immediate[k])] for k in range(len(stations))]
+    for j, col in enumerate(values.columns):
+        table[col] = areas[:, j]
+    for j, col in enumerate(loads.columns):
+        table[col] = incremental[:, j]
+    for j, load_col in enumerate(loads.columns):
+        for a, area_col in enumerate(values.columns):
+            table[str(load_col) + "_per_" + str(area_col)] = incremental[:, j] / areas[:, a]
+
+    return table
+
+def build_node_cache(lake_gdf, riv_gdf, source=None):
+    """
+    Build a table of node attributes indexed by node (COMID, or Node for pollutant sources) that can
+    be shared by the plotting and coloring functions. The table contains the x and y coordinates of the
+    centroid of each node, the node type ("river", "lake", or "source"), and the huc8, huc10, and huc12
+    codes of the node when they are in the given dataframes
+
+    If a COMID is in more than one dataframe, the river attributes are used before the waterbody 
+    attributes, and the waterbody attributes are used before the source attributes. If a COMID appears
+    more than once in a dataframe, the first row is used (as in get_pos_dict)
+
+    Build the cache once for the whole network and pass it as node_cache to get_pos_dict, 
+    get_pos_dict_with_pollutant, color_nodes, and the get_*_graph_and_cols functions, so that centroids 
+    are not recomputed for every plot
+    """
+
+    huc_cols = ["huc8", "huc10", "huc12"]
+
+    tables = [(riv_gdf, "COMID", "river"), (lake_gdf, "COMID", "lake")]
+    if source is not None:
+        tables.append((source, "Node", "source"))
+
+    frames = []
+    for gdf, key, node_type in tables:
+        cent_vals = gdf.geometry.centroid
+        frame = pd.DataFrame({"x": cent_vals.x.values, "y": cent_vals.y.values, "node_type": node_type}, 
+                             index=pd.Index(gdf[key].values, name="node"))
+        for col in huc_cols:
+            frame[col] = gdf[col].values if col in gdf.columns else np.nan
+        frames.append(frame)
+
+    # Keep the first row of each node, in the order of precedence above
+    cache = pd.concat(frames)
+    return cache[~cache.index.duplicated(keep="first")]
+
+def _cached_nodes(G, node_cache):
+    """
+    Return the rows of the node cache for the nodes of G, in the order of G.nodes
+    """
+
+    nodes = list(G.nodes)
+    rows  = node_cache.index.get_indexer(nodes)
+    if (rows < 0).any():
+        raise KeyError("Nodes are not in the node cache: " + str([j for j, r in zip(nodes, rows) if r < 0]))
+
+    return nodes, node_cache.iloc[rows]
+
+def _pos_dict(nodes, rows):
+    """
+    Return a dictionary of node positions from the rows of the node cache
+    """
+
+    xy = rows[["x", "y"]].to_numpy(dtype=float)
+    return dict(zip(nodes, xy))
+
+# Version of the files written by save_network; networks saved with another version are not loaded
+NETWORK_FORMAT_VERSION = 1
+
+def network_input_hash(*frames):
+    """
+    Return a hash of the dataframes a network is built from (e.g., the to-from list and the waterbody 
+    and river GeoDataFrames). The hash changes whenever any value or geometry in the dataframes changes
+    """
+
+    digest = hashlib.sha256()
+    for df in frames:
+        if isinstance(df, gpd.GeoDataFrame):
+            # Each geometry is hashed with the length of its WKB, so geometries of any size are hashed
+            # one at a time and no two different lists of geometries give the same bytes
+            for wkb in df.geometry.to_wkb():
+                digest.update(len(wkb).to_bytes(8, "little"))
+                digest.update(wkb)
+            df = pd.DataFrame(df.drop(columns=df.geometry.name))
+        # Columns of Python objects (e.g., lists of COMIDs) are hashed by their text representation
+        df = pd.DataFrame({col: df[col].map(repr) if df[col].dtype == object else df[col] for col in df.columns})
+        digest.update(",".join(map(str, df.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+    return digest.hexdigest()
+
+def save_network(G, path, node_cache=None, input_hash=None):
+    """
+    Save a network (a networkx DiGraph, e.g., from build_graph after aggregate_river_nodes, or a CSRGraph)
+    to the directory path so that it can be loaded with load_network. The node labels and the CSR edge
+    arrays are saved as .npy files, which are memory-mapped when they are loaded. If node_cache (from 
+    build_node_cache) is given, its columns are also saved for every node of the network (nodes that
+    are not in the cache are given NaN, or an empty string for the node type)
+
+    input_hash (e.g., from network_input_hash) is saved with the network, so that load_network can check
+    that the network was built from the current inputs. Edge and node attributes of the networkx graph
+    are not saved
+    """
+
+    graph = G if isinstance(G, CSRGraph) else CSRGraph.from_networkx(G)
+    os.makedirs(path, exist_ok=True)
+
+    # Numeric labels (COMIDs) are saved as an array; any other labels (e.g., pollutant sources) are saved
+    # as a list, which keeps the type of every label
+    if graph.nodes.dtype.kind in "iuf":
+        np.save(os.path.join(path, "nodes.npy"), graph.nodes)
+        labels = "npy"
+    else:
+        with open(os.path.join(path, "nodes.json"), "w") as f:
+            json.dump([i.item() if isinstance(i, np.generic) else i for i in graph.nodes.tolist()], f)
+        labels = "json"
+
+    np.save(os.path.join(path, "indptr.npy"), graph.indptr)
+    np.save(os.path.join(path, "indices.npy"), graph.indices)
+
+    # Save each attribute column as its own array, in the order of the nodes
+    columns = []
+    if node_cache is not None:
+        table = node_cache.reindex(graph.index)
+        for col in table.columns:
+            values = table[col]
+            if values.dtype.kind in "biuf":
+                values = values.to_numpy()
+            else:
+                values = np.array(values.fillna("").astype(str).tolist(), dtype=str)
+            np.save(os.path.join(path, "attr_" + str(col) + ".npy"), values)
+            columns.append(str(col))
+
+    metadata = {
+        "version":    NETWORK_FORMAT_VERSION,
+        "input_hash": input_hash,
+        "n_nodes":    graph.number_of_nodes(),
+        "n_edges":    graph.number_of_edges(),
+        "labels":     labels,
+        "attributes": columns,
+    }
+    with open(os.path.join(path, "network.json"), "w") as f:
+        json.dump(metadata, f, indent=1)
+
+def load_network(path, input_hash=None, mmap_mode="r"):
+    """
+    Load a network saved with save_network. The arrays are memory-mapped (unless mmap_mode is None), so
+    loading does not read the whole network and several processes can share the same pages. Raises a
+    ValueError if the network was saved with another format version, or (if input_hash is given) was 
+    built from different inputs
+
+    Returns the network as a CSRGraph (use its to_networkx method to get the networkx DiGraph back, with
+    the same nodes, edges, and node order) and a dataframe of the saved node attributes indexed by node
+    (None if no attributes were saved)
+    """
+
+    with open(os.path.join(path, "network.json")) as f:
+        metadata = json.load(f)
+
+    if metadata["version"] != NETWORK_FORMAT_VERSION:
+        raise ValueError("Network in " + path + " has format version " + str(metadata["version"]) + 
+                         "; expected version " + str(NETWORK_FORMAT_VERSION))
+    if input_hash is not None and metadata["input_hash"] != input_hash:
+        raise ValueError("Network in " + path + " was built from different inputs")
+
+    if metadata["labels"] == "npy":
+        nodes = np.load(os.path.join(path, "nodes.npy"), mmap_mode=mmap_mode)
+    else:
+        with open(os.path.join(path, "nodes.json")) as f:
+            nodes = _label_array(json.load(f))
+
+    indptr  = np.load(os.path.join(path, "indptr.npy"), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(path, "indices.npy"), mmap_mode=mmap_mode)
+    graph   = CSRGraph(nodes, indptr, indices)
+
+    if len(metadata["attributes"]) == 0:
+        return graph, None
+
+    attributes = pd.DataFrame({col: np.load(os.path.join(path, "attr_" + col + ".npy"), mmap_mode=mmap_mode) 
+                               for col in metadata["attributes"]}, index=pd.Index(graph.nodes, name="node"), copy=False)
+
+    return graph, attributes
+
+def get_pos_dict(G, lake_gdf, riv_gdf, n_size = 10,lake_color="blue", river_color="red", node_cache=None):
     """
     Return a dictionary containing geographic locations of nodes for plotting.
     Also return a list of node colors and node_sizes. These will be used to plot
     the graph network and give different colors to different node types
 
     Takes inputs of a networkX directed graph (G), a waterbody GeoDataFrame (lake_gdf),
-    and a river GeoDataFrame (riv_gdf)
+    and a river GeoDataFrame (riv_gdf). If node_cache (from build_node_cache) is given,
+    the positions are taken from the cache instead of being computed from lake_gdf and riv_gdf
     """
     
-    # Define a dictionary to fill with geographic positions for the nodes
-    G_pos = dict()
-    
-    # Define empty lists for the node colors and node sizes
-    node_colors = []
-    node_size   = []
-    
-    # Iterate through the nodes of G
-    for j in tqdm((G.nodes)):
-        
-        # If the given node from G is in the river gdf, then take the geographic
-        # location from riv_gdf; also set the color and size accordingly
-        if np.isin(j, riv_gdf.COMID.values):
-            poly_val = riv_gdf.geometry[riv_gdf.COMID == j]
-            cent_val = poly_val.centroid
-            node_colors.append(river_color)
-            node_size.append(n_size)
-        
-        # If the given node from G is not a river gdf, then it must be a waterbody gdf.
-        # Take the geographic location from lake_gdf, and set the color and size
-        else:
-            poly_val = lake_gdf.geometry[lake_gdf.COMID == j]
-            cent_val = poly_val.centroid
-            node_colors.append(lake_color)
-            node_size.append(n_size)
-            
-        # Set the position as the x and y coordinate of the centroid of the river or waterbody object
-        G_pos[j] = (np.array([cent_val.x.values[0], cent_val.y.values[0]]))
+    if node_cache is None:
+        node_cache = build_node_cache(lake_gdf, riv_gdf)
+
+    # Look up the rows of all nodes of G at once
+    nodes, rows = _cached_nodes(G, node_cache)
+
+    # River nodes are given the river color; any other node must be a waterbody
+    is_river    = rows.node_type.values == "river"
+    node_colors = np.where(is_river, river_color, lake_color).tolist()
+    node_size   = [n_size] * len(nodes)
+
+    # Return the dictionary of positions (the centroids of the objects) and the lists of node colors and sizes
+    return _pos_dict(nodes, rows), node_colors, node_size
+
+def network_diagnostics(G, report_path=None):
+    """
+    Check the structure of a network in time linear in its size. G can be a networkx DiGraph, a CSRGraph,
+    or a ReachabilityIndex. Returns a dictionary (which is also written as JSON to report_path, if given) 
+    with the number of nodes, edges, and weakly connected components, and the following lists of nodes:
+
+     * "cyclic_components" - the nodes of every strongly connected component containing a cycle (more 
+       than one node, or a node with an edge to itself)
+     * "self_loops" - nodes with an edge to themselves
+     * "sinks" - nodes with no downstream nodes (outlets)
+     * "sources" - nodes with no upstream nodes (headwaters)
+     * "orphans" - nodes with no edges
+     * "multi_outlet" - nodes with more than one downstream node (e.g., braided channels)
+     * "multi_outlet_components" - the sinks of every weakly connected component with more than one sink
+    """
+
+    index = G if isinstance(G, ReachabilityIndex) else ReachabilityIndex(G)
+    graph = index.graph
+    n     = graph.number_of_nodes()
+    nodes = graph.nodes
+
+    out_degree = np.diff(graph.indptr)
+    in_degree  = np.diff(graph.rindptr)
+    sources    = np.repeat(np.arange(n, dtype=np.int64), out_degree)
+
+    # Components with more than one node or with a self-loop contain a cycle
+    self_loop = np.zeros(n, dtype=bool)
+    self_loop[sources[sources == graph.indices]] = True
+    comp_size = np.bincount(index.component, minlength=index.n_components)
+    comp_loop = np.zeros(index.n_components, dtype=bool)
+    comp_loop[index.component[self_loop]] = True
+    cyclic    = (comp_size > 1) | comp_loop
+
+    cyclic_nodes = np.flatnonzero(cyclic[index.component])
+    cyclic_groups = pd.Series(cyclic_nodes).groupby(index.component[cyclic_nodes]).indices
+
+    # Weakly connected components, and the sinks of each
+    adjacency = csr_matrix((np.ones(len(graph.indices), dtype=np.int8), graph.indices, graph.indptr), shape=(n, n))
+    n_weak, weak = connected_components(adjacency, directed=True, connection="weak")
+    sinks = np.flatnonzero(out_degree == 0)
+    sink_count  = np.bincount(weak[sinks], minlength=n_weak)
+    multi_sinks = sinks[sink_count[weak[sinks]] > 1]
+
+    # Group the sinks by component with a single sort (sinks keep their order within each component)
+    multi_sinks = multi_sinks[np.argsort(weak[multi_sinks], kind="stable")]
+    _, starts   = np.unique(weak[multi_sinks], return_index=True)
+    multi_groups = np.split(multi_sinks, starts[1:])
+
+    report = {
+        "n_nodes":                 int(n),
+        "n_edges":                 int(graph.number_of_edges()),
+        "n_weak_components":       int(n_weak),
+        "cyclic_components":       [nodes[cyclic_nodes[pos]].tolist() for pos in cyclic_groups.values()],
+        "self_loops":              nodes[self_loop].tolist(),
+        "sinks":                   nodes[sinks].tolist(),
+        "sources":                 nodes[in_degree == 0].tolist(),
+        "orphans":                 nodes[(in_degree == 0) & (out_degree == 0)].tolist(),
+        "multi_outlet":            nodes[out_degree > 1].tolist(),
+        "multi_outlet_components": [nodes[group].tolist() for group in multi_groups if len(group) > 0],
+    }
+
+    if report_path is not None:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1, default=lambda i: i.item() if isinstance(i, np.generic) else str(i))
+
+    return report
+
+def check_network(G, report_path=None, allow_cycles=False, allow_orphans=False, allow_multi_outlet=True):
+    """
+    Gate for graph builds. Runs network_diagnostics (writing the report to report_path, if given) and 
+    raises a ValueError if the network contains cycles or orphan nodes, or nodes with more than one
+    downstream node, unless they are allowed. Returns the report
+    """
+
+    report   = network_diagnostics(G, report_path)
+    problems = []
+
+    if not allow_cycles and len(report["cyclic_components"]) > 0:
+        problems.append(str(len(report["cyclic_components"])) + " components containing cycles")
+    if not allow_orphans and len(report["orphans"]) > 0:
+        problems.append(str(len(report["orphans"])) + " orphan nodes")
+    if not allow_multi_outlet and len(report["multi_outlet"]) > 0:
+        problems.append(str(len(report["multi_outlet"])) + " nodes with more than one downstream node")
 
-    # Return the dictionary of positions and the lists of node colors and sizes
-    return G_pos, node_colors, node_size
+    if len(problems) > 0:
+        raise ValueError("Network failed the checks: " + ", ".join(problems))
+
+    return report
 
 def count_cycles(G):
 
     """
-    Count the number of cycles in the graph, G. Print the result
+    Count the number of strongly connected components of the graph, G, that contain a cycle (see
+    network_diagnostics). Print and return the result. Unlike enumerating every cycle, this takes time
+    linear in the size of the graph
     """
 
-    counter = 0
-    for i in nx.simple_cycles(G):
-        counter += 1
+    counter = len(network_diagnostics(G)["cyclic_components"])
     print(counter)
 
-def get_downstream_graph_and_cols(G, node, lake_gdf, river_gdf):
+    return counter
 
+def _traversal_graph(G, node, reverse):
     """
-    Construct the downstream graph of a given node
-    Return the downstream graph and the set of node colors based on whether the 
-    nodes are waterbody or river nodes
+    Construct the graph induced by all nodes that lie downstream (or upstream, if reverse is True)
+    of a given node. The traversed nodes are kept in a set, so testing whether an edge lies in the
+    graph takes constant time
     """
 
-    # Build a list of all nodes that lie downstream of a given node
-    downstream = [n for n in nx.traversal.bfs_tree(G, node, reverse=False)]
+    # Build a list of all nodes that lie downstream (upstream) of a given node
+    nodes     = [n for n in nx.traversal.bfs_tree(G, node, reverse=reverse)]
+    node_set  = set(nodes)
     
     # Define a directed graph
     subG = nx.DiGraph()
 
     # Add the node of interest to the given graph. This ensures that the returned graph will not
-    # be empty if the given node is at the end of the graph (i.e., it has no downstream graph)
+    # be empty if the given node has no downstream (upstream) graph
     subG.add_node(node)
 
-    # Iterate through the list of downstream nodes    
-    for j in downstream:
-        # Get all incident edges to j
-        edge_list = G.edges(j)
-        
-        # Iterate through the edge list; if both ends of the edge are in the set of downstream
-        # nodes, then add that edge to the downstream graph
-        for i in edge_list:
-            if i[0] in downstream and i[1] in downstream:
-                subG.add_edge(i[0], i[1])
-    
-    # Define an empty list to fill with node colors
-    # this can be used for plotting with networkx.draw
+    # Iterate through the list of nodes; if both ends of an edge incident to a node are in the set 
+    # of traversed nodes, then add that edge to the graph
+    subG.add_edges_from(i for j in nodes for i in G.edges(j) if i[1] in node_set)
+
+    return subG
+
+def _subgraph_colors(subG, lake_gdf, river_gdf, node_cache=None):
+    """
+    Return a list of node colors for a graph; river nodes are red, waterbody nodes are blue,
+    and any other nodes (e.g., pollutant nodes) are orange
+    """
+
+    # The node cache already holds the node types
+    if node_cache is not None:
+        return color_nodes(subG, lake_gdf, river_gdf, None, node_cache=node_cache)[0]
+
+    river_set = set(river_gdf.COMID.values.tolist())
+    lake_set  = set(lake_gdf.COMID.values.tolist())
+
     node_colors = []
-    
-    # Iterate through the nodes of the downstream graph; make river nodes red, waterbody nodes blue,
-    # and any other nodes orange (this may include pollutant nodes)
     for i in subG.nodes:
-        if i in river_gdf.COMID.values:
+        if i in river_set:
             node_colors.append("red")
-        elif i in lake_gdf.COMID.values:
+        elif i in lake_set:
             node_colors.append("blue")
         else:
             node_colors.append("orange")
-    
-    # Return the downstream graph and the list of colors
-    return subG, node_colors
 
+    return node_colors
 
-def get_downstream_graph(G, node):
+def get_downstream_graph_and_cols(G, node, lake_gdf, river_gdf, node_cache=None):
 
     """
     Construct the downstream graph of a given node
+    Return the downstream graph and the set of node colors based on whether the 
+    nodes are waterbody or river nodes. If node_cache (from build_node_cache) is given,
+    the node types are taken from the cache
     """
 
-    # Build a list of all nodes that lie downstream of a given node
-    downstream = [n for n in nx.traversal.bfs_tree(G, node, reverse=False)]
-    
-    # Define a directed graph
-    subG = nx.DiGraph()
+    subG = _traversal_graph(G, node, reverse=False)
 
-    # Add the node of interest to the given graph. This ensures that the returned graph will not
-    # be empty if the given node is at the end of the graph (i.e., it has no downstream graph)
-    subG.add_node(node)
+    # Return the downstream graph and the list of colors
+    return subG, _subgraph_colors(subG, lake_gdf, river_gdf, node_cache)
+
+
+def get_downstream_graph(G, node):
+
+    """
+    Construct the downstream graph of a given node
+    """
 
-    # Iterate through the list of downstream nodes    
-    for j in downstream:
-        # Get all incident edges to j
-        edge_list = G.edges(j)
-        
-        # Iterate through the edge list; if both ends of the edge are in the set of downstream
-        # nodes, then add that edge to the downstream graph
-        for i in edge_list:
-            if i[0] in downstream and i[1] in downstream:
-                subG.add_edge(i[0], i[1])
-        
     # Return the downstream graph
-    return subG
+    return _traversal_graph(G, node, reverse=False)
 
-def get_upstream_graph_and_cols(G, node, lake_gdf, river_gdf):
+def get_upstream_graph_and_cols(G, node, lake_gdf, river_gdf, node_cache=None):
     
     """
     Construct the upstream graph of a given node
     Return the upstream graph and the set of node colors based on whether the 
-    nodes are waterbody or river nodes
+    nodes are waterbody or river nodes. If node_cache (from build_node_cache) is given,
+    the node types are taken from the cache
     """
     
-    # Build a list of all nodes that lie upstream of a given node
-    upstream = [n for n in nx.traversal.bfs_tree(G, node, reverse=True)]
-    
-    # Define a directed graph
-    subG = nx.DiGraph()
-
-    # Add the node of interest to the given graph. This ensures that the returned graph will not
-    # be empty if the given node is at the start of the graph (i.e., it has no upstream graph)
-    subG.add_node(node)
-    
-    # Iterate through the list of upstream nodes
-    for j in upstream:
-        # Get all incident edges to j
-        edge_list = G.edges(j)
-
-        # Iterate through the edge list; if both ends of the edge are in the set of upstream
-        # nodes, then add that edge to the upstream graph       
-        for i in edge_list:
-            if i[0] in upstream and i[1] in upstream:
-                subG.add_edge(i[0], i[1])
-    
-    # Define an empty list to fill with node colors
-    # this can be used for plotting with networkx.draw
-    node_colors = []
-
-    # Iterate through the nodes of the downstream graph; make river nodes red, waterbody nodes blue,
-    # and any other nodes orange (this may include pollutant nodes)
-    for i in subG.nodes:
-        if i in river_gdf.COMID.values:
-            node_colors.append("red")
-        elif i in lake_gdf.COMID.values:
-            node_colors.append("blue")
-        else:
-            node_colors.append("orange")
+    subG = _traversal_graph(G, node, reverse=True)
             
-    # Return the downstream graph and the list of colors
-    return subG, node_colors
+    # Return the upstream graph and the list of colors
+    return subG, _subgraph_colors(subG, lake_gdf, river_gdf, node_cache)
 
 def get_upstream_graph(G, node):
 
@@ -670,33 +1594,206 @@ def get_upstream_graph(G, node):
     Construct the upstream graph of a given node
     """
 
-    # Build a list of all nodes that lie upstream of a given node
-    upstream = [n for n in nx.traversal.bfs_tree(G, node, reverse=True)]
-    
-    # Define a directed graph
-    subG = nx.DiGraph()
+    # Return the upstream graph
+    return _traversal_graph(G, node, reverse=True)
 
-    # Add the node of interest to the given graph. This ensures that the returned graph will not
-    # be empty if the given node is at the start of the graph (i.e., it has no upstream graph)
-    subG.add_node(node)
-    
-    # Iterate through the list of upstream nodes
-    for j in upstream:
-        # Get all incident edges to j
-        edge_list = G.edges(j)
-
-        # Iterate through the edge list; if both ends of the edge are in the set of upstream
-        # nodes, then add that edge to the upstream graph       
-        for i in edge_list:
-            if i[0] in upstream and i[1] in upstream:
-                subG.add_edge(i[0], i[1])
-    
-    
-    # Return the downstream graph
-    return subG
+def _nearest_in_groups(points, point_groups, geoms, geom_groups, max_distance=None):
+    """
+    For every point, find the nearest geometry that has the same group code as the point (e.g., the 
+    same HUC12). The geometries of each group are indexed once, and all points of the group are matched
+    in a single nearest-neighbor query against that index. If max_distance is given, points farther 
+    than max_distance from every geometry in their group are not matched. If several geometries are
+    equally close, the first one in geoms is used
+
+    Returns the position in geoms of the nearest geometry for every point (-1 if there is no match)
+    and the distance to it (NaN if there is no match)
+    """
+
+    points = gpd.GeoSeries(points).values
+    geoms  = gpd.GeoSeries(geoms).values
 
+    match    = np.full(len(points), -1, dtype=np.int64)
+    distance = np.full(len(points), np.nan)
 
-def add_CAFOS_to_graph(G_old, lake_gdf, river_gdf, CAFOS):
+    # Positions of the points and geometries in each group
+    point_positions = pd.Series(np.asarray(point_groups)).groupby(np.asarray(point_groups)).indices
+    geom_positions  = pd.Series(np.asarray(geom_groups)).groupby(np.asarray(geom_groups)).indices
+
+    for group, pt_pos in point_positions.items():
+        if group not in geom_positions:
+            continue
+        geom_pos = geom_positions[group]
+
+        # Query the nearest geometries for all points in the group at once
+        pairs, dist = gpd.GeoSeries(geoms[geom_pos]).sindex.nearest(points[pt_pos], return_all=True,
+                                                                    max_distance=max_distance, return_distance=True)
+        pt_idx, geom_idx = pairs[0], pairs[1]
+
+        # If several geometries are equally close to a point, keep the first one
+        order    = np.lexsort((geom_idx, pt_idx))
+        pt_idx   = pt_idx[order]
+        geom_idx = geom_idx[order]
+        dist     = dist[order]
+        first    = np.ones(len(pt_idx), dtype=bool)
+        first[1:] = pt_idx[1:] != pt_idx[:-1]
+
+        match[pt_pos[pt_idx[first]]]    = geom_pos[geom_idx[first]]
+        distance[pt_pos[pt_idx[first]]] = dist[first]
+
+    return match, distance
+
+def nearest_source_nodes(G, lake_gdf, river_gdf, source, max_distance=None):
+    """
+    Find the node of graph G that each pollutant source should be attached to. This is the nearest 
+    river or waterbody node in G that lies in the same HUC12 as the source. Sources with no node in
+    their HUC12, or (if max_distance is given) with no node within max_distance, are not attached.
+    Distances are in the units of the coordinate reference system of the GeoDataFrames
+
+    source dataframe must contain an identifying column called "Node" and a "huc12" column
+
+    Returns a dataframe with the columns "Node", "COMID", and "distance" for every attached source,
+    in the order of the sources
+    """
+
+    # Make a list of all the nodes comprising graph G
+    all_nodes = [i for i in G.nodes]
+
+    # Build a concatenated dataframe containing the COMIDs, huc12 codes, and geometry for all waterbody and river nodes that are in the graph
+    node_df = pd.concat([lake_gdf[["COMID", 'huc12', 'geometry']][lake_gdf.COMID.isin(all_nodes)], river_gdf[['COMID', 'huc12','geometry']][river_gdf.COMID.isin(all_nodes)]])
+
+    match, distance = _nearest_in_groups(source.geometry.values, source.huc12.values, node_df.geometry.values, node_df.huc12.values, max_distance)
+    found = match >= 0
+
+    return pd.DataFrame({
+        "Node":     source.Node.values[found],
+        "COMID":    node_df.COMID.values[match[found]],
+        "distance": distance[found],
+    })
+
+# CRS of each horizontal datum used for the station coordinates in the Water Quality Portal data
+STATION_DATUMS = {"NAD27": "EPSG:4267", "NAD83": "EPSG:4269", "WGS84": "EPSG:4326"}
+
+class StationLocator:
+    """
+    Snap monitoring stations (e.g., the stations in station_data.csv) to the NHD features and the nodes of 
+    the graph. The waterbody and river features are projected to crs (distances are in its units) and
+    indexed once when the locator is built; each call to snap then matches all of its stations in one
+    nearest-neighbor query per HUC8
+
+    If node_map (from contract_river_nodes) is given, every COMID is also mapped to the aggregated node it
+    was merged into. If G is given, only features whose node is in G are used. Stations are matched to the
+    nearest feature in their HUC8 (or to the nearest feature of any HUC8 if by_huc8 is False); if several
+    features are equally close, the waterbody is used
+
+    Snapped stations are cached by station ID, so stations that were already snapped are not matched again
+    """
+
+    def __init__(self, lake_gdf, river_gdf, node_map=None, G=None, crs="EPSG:3071"):
+
+        # Build a single dataframe of all waterbody and river features, with the waterbodies first
+        features = pd.concat([lake_gdf[["COMID", "huc8", "huc12", "geometry"]].assign(node_type="lake"),
+                              river_gdf[["COMID", "huc8", "huc12", "geometry"]].assign(node_type="river")])
+        features = gpd.GeoDataFrame(features, geometry="geometry", crs=river_gdf.crs).to_crs(crs)
+
+        # Get the aggregated node of every COMID
+        comids = features.COMID.values
+        features["node"] = comids if node_map is None else _map_values(comids, node_map)
+
+        if G is not None:
+            features = features[features.node.isin(list(G.nodes))]
+
+        self.features = features.reset_index(drop=True)
+        self.crs      = crs
+        self._cache   = dict()
+
+        # Build the spatial index now, so that it is only built once
+        self.features.sindex
+
+    def station_points(self, stations, lat_col="LatitudeMeasure", lon_col="LongitudeMeasure",
+                       datum_col="HorizontalCoordinateReferenceSystemDatumName", station_crs="EPSG:4269"):
+        """
+        Return the locations of the stations as a GeoSeries in the CRS of the locator. The coordinates are
+        read from lat_col and lon_col, in the horizontal datum given for each station in datum_col (NAD27, 
+        NAD83, or WGS84, as in the Water Quality Portal data); the stations of each datum are reprojected 
+        separately. If datum_col is None or not a column of stations, every station is taken to be in 
+        station_crs (NAD83 by default)
+
+        Raises a ValueError if a station with coordinates has a datum that is not in STATION_DATUMS
+        """
+
+        points = gpd.points_from_xy(stations[lon_col].values, stations[lat_col].values)
+
+        if datum_col is None or datum_col not in stations.columns:
+            return gpd.GeoSeries(points, crs=station_crs).to_crs(self.crs)
+
+        # Stations without coordinates are left as they are, whatever their datum
+        datums  = stations[datum_col].values
+        located = stations[lon_col].notna().values & stations[lat_col].notna().values
+        unknown = sorted(set(map(str, datums[located])) - set(STATION_DATUMS))
+        if len(unknown) > 0:
+            raise ValueError("Unknown horizontal datums in " + datum_col + ": " + ", ".join(unknown))
+
+        # Reproject the stations of each datum to the CRS of the locator, keeping the order of the stations
+        projected = gpd.GeoSeries(points, crs=self.crs).values.copy()
+        for datum, crs in STATION_DATUMS.items():
+            rows = np.flatnonzero(located & (datums == datum))
+            if len(rows) > 0:
+                projected[rows] = gpd.GeoSeries(points[rows], crs=crs).to_crs(self.crs).values
+
+        return gpd.GeoSeries(projected, index=range(len(stations)), crs=self.crs)
+
+    def snap(self, stations, id_col="MonitoringLocationIdentifier", huc8_col="HUCEightDigitCode", by_huc8=True,
+             max_distance=None, **point_kwargs):
+        """
+        Snap every station to the nearest feature. Stations farther than max_distance from every feature 
+        (if max_distance is given) or without coordinates are not snapped. Additional keyword arguments
+        are passed to station_points
+
+        Returns a dataframe with the columns id_col, "COMID", "node", "node_type", "huc12", and "distance" 
+        for every snapped station, in the order of the stations
+        """
+
+        key   = (id_col, huc8_col if by_huc8 else None, max_distance, tuple(sorted(point_kwargs.items())))
+        cache = self._cache.get(key)
+
+        # Only the stations that are not in the cache are matched
+        ids  = stations[id_col].values
+        new  = stations if cache is None else stations[~pd.Index(ids).isin(cache.index)]
+        new  = new.drop_duplicates(id_col)
+
+        if len(new) > 0:
+            points  = self.station_points(new, **point_kwargs)
+            located = ~points.is_empty.values & points.x.notna().values & points.y.notna().values
+
+            # Without by_huc8, every station and feature is put in the same group
+            groups = new[huc8_col].values if by_huc8 else np.zeros(len(new))
+            feature_groups = self.features.huc8.values if by_huc8 else np.zeros(len(self.features))
+
+            match    = np.full(len(new), -1, dtype=np.int64)
+            distance = np.full(len(new), np.nan)
+            match[located], distance[located] = _nearest_in_groups(points.values[located], groups[located], 
+                                                                   self.features.geometry.values, feature_groups, max_distance)
+
+            snapped = pd.DataFrame({"match": match, "distance": distance}, index=pd.Index(new[id_col].values, name=id_col))
+            cache   = snapped if cache is None else pd.concat([cache, snapped])
+            self._cache[key] = cache
+
+        # Look up the stations in the cache
+        rows  = cache.reindex(ids)
+        match = rows.match.values.astype(np.int64)
+        found = match >= 0
+        feats = self.features.iloc[match[found]]
+
+        return pd.DataFrame({
+            id_col:      ids[found],
+            "COMID":     feats.COMID.values,
+            "node":      feats.node.values,
+            "node_type": feats.node_type.values,
+            "huc12":     feats.huc12.values,
+            "distance":  rows.distance.values[found],
+        })
+
+def add_CAFOS_to_graph(G_old, lake_gdf, river_gdf, CAFOS, max_distance=None):
     """
     This function was specifically designed for adding CAFOs to a graph that is already defined. 
     This function could be applied to point sources other than CAFOS, by passing a GeoDataFrame containing pollutant
@@ -704,136 +1801,67 @@ def add_CAFOS_to_graph(G_old, lake_gdf, river_gdf, CAFOS):
     column called 'Node'. 
 
     CAFOs are added by placing an edge between the CAFO and the closest node in the graph that is also in the HUC12 of the CAFO.
+    If max_distance is given, CAFOs farther than max_distance from every node in their HUC12 are not added
     """
 
     # Make a copy of the graph passed to this function; this prevents making changes to the original graph, G_old
     G = G_old.copy()
     
-    # Make a list of all the nodes comprising graph G
-    all_nodes = [i for i in G.nodes]
-    # Build a concatenated dataframe containing the COMIDs, huc12 codes, and geometry for all waterbody and river nodes that are in the graph
-    node_df = pd.concat([lake_gdf[["COMID", 'huc12', 'geometry']][lake_gdf.COMID.isin(all_nodes)].copy(), river_gdf[['COMID', 'huc12','geometry']][river_gdf.COMID.isin(all_nodes)].copy()])
-    
-    # Loop through the list of CAFOS
-    for i in range(len(CAFOS)):
-        # Define the huc the CAFO is in, the location of the CAFO, and the name of the CAFO
-        huc = CAFOS.huc12.iloc[i]
-        point = CAFOS.geometry.iloc[i]
-        cafo_name = CAFOS.Node.iloc[i]
-        
-        # Get a dataframe of all waterbody and river nodes in the graph that are also in the CAFO's huc12
-        df_in_huc = node_df[node_df.huc12 == huc].copy()
-        df_in_huc = df_in_huc.reset_index(drop=True)
-        
-        # For nodes in the huc, define the distances from the CAFO location
-        distances = df_in_huc.distance(point)
-        
-        # If there are other nodes in the huc, then add an edge from the CAFO to the closest node
-        if len(df_in_huc) != 0:
-            comid_to_connect = df_in_huc.COMID.values[distances == min(distances)][0]
-        
-            G.add_edge(cafo_name, comid_to_connect)
+    # Find the closest node in the graph that is also in the CAFO's huc12 for every CAFO
+    attachments = nearest_source_nodes(G, lake_gdf, river_gdf, CAFOS, max_distance)
+
+    # Add an edge from each CAFO to its closest node
+    G.add_edges_from(zip(attachments.Node.tolist(), attachments.COMID.tolist()))
 
     # Return the graph with the CAFOs added. 
     return G
         
-def build_graph_with_pollutants(tofroms,lake_gdf, river_gdf, source):
+def build_graph_with_pollutants(tofroms,lake_gdf, river_gdf, source, max_distance=None):
     """
     Build a graph from GeoDataFrames for waterbodies, rivers, and pollutant sources. 
 
     source dataframe must contain an identifying column called "Node"
 
     Pollutant sources are added by placing an edge between the source and the nearest
-    river or waterbody node that lies in the same HUC12
+    river or waterbody node that lies in the same HUC12. If max_distance is given, sources
+    farther than max_distance from every node in their HUC12 are not added
     """
 
-    # Build a concatenated dataframe containing the COMIDs, huc12 codes, and geometry for all waterbody and river nodes that are in the graph
-    node_df = pd.concat([lake_gdf[["COMID", 'huc12']], river_gdf[['COMID', 'huc12']]])
-    
-    # Define a directed graph
-    G = nx.DiGraph()
-    
-    # Loop through the list of to-froms; add edges to the graph for each of these
-    for j in range(len(tofroms)):
-        from_node = tofroms.FROMCOMID.iloc[j]
-        to_node   = tofroms.TOCOMID.iloc[j]
-        
-        if from_node != to_node:
-            G.add_edge(from_node, to_node)
-    
-    # Get a set of all nodes in the graph
-    all_nodes = [i for i in G.nodes]
+    # Build the directed graph from the list of to-froms
+    G = build_graph(tofroms)
     
-    # Loop through the list of sources
-    for i in range(len(source)):
-        # define the huc the source is in
-        huc = source.huc12.iloc[i]
-        point = source.geometry.iloc[i]
-        source_name = source.Node.iloc[i]
-
-        # Get a dataframe of all waterbody and river nodes in the graph that are also in the source's huc12
-        df_in_huc = node_df[(node_df.huc12 == huc) & node_df.COMID.isin(all_nodes)].copy()
-        df_in_huc = df_in_huc.reset_index(drop=True)
-        
-        # For nodes in the huc, define the distances from the source location
-        distances = df_in_huc.distance(point)
-        
-        # If there are other nodes in the huc, then add an edge from the source to the closest node
-        if len(df_in_huc) != 0:
-            # Get the COMID of the closest node
-            comid_to_connect = df_in_huc.COMID.values[distances == min(distances)][0]
-        
-            # Add an edge from the source to the comid
-            G.add_edge(source_name, comid_to_connect)
+    # Find the nearest node in the source's huc12 for every source, and add an edge from the source to that node
+    attachments = nearest_source_nodes(G, lake_gdf, river_gdf, source, max_distance)
+    G.add_edges_from(zip(attachments.Node.tolist(), attachments.COMID.tolist()))
 
     return G
 
-def get_pos_dict_with_pollutant(G, lake_gdf, riv_gdf, source):
+def get_pos_dict_with_pollutant(G, lake_gdf, riv_gdf, source, node_cache=None):
     """
     Return a dictionary containing geographic locations of nodes for plotting.
     Also return a list of node colors and node_sizes. These will be used to plot
     the graph network and give different colors to different node types
 
     Takes inputs of a networkX directed graph (G), a waterbody GeoDataFrame (lake_gdf),
-    a river GeoDataFrame (riv_gdf), and a source GeoDataframe (source)
+    a river GeoDataFrame (riv_gdf), and a source GeoDataframe (source). If node_cache 
+    (from build_node_cache) is given, the positions are taken from the cache
     """
 
-    # Define an empty dictionary
-    G_pos = dict()
-    
-    # Define empty lists for node colors and node size
-    node_colors= []
-    node_size = []
-    
-    # Loop through the set of ndoes in the graph
-    for j in tqdm((G.nodes)):
-        
-        # If a node is a river, make the node color red
-        if np.isin(j, riv_gdf.COMID.values):
-            poly_val = riv_gdf.geometry[riv_gdf.COMID == j]
-            cent_val = poly_val.centroid
-            node_colors.append("red")
-            node_size.append(10)
-        # If the node is a pollutant source, make the node color orange
-        elif np.isin(j, source.Node.values):
-            cent_val = source.geometry[source.Node == j]
-            node_colors.append("orange")
-            node_size.append(30)
-        # If the node isn't a river or a source, it must be a waterbody; make the ndoe color blue
-        else:
-            poly_val = lake_gdf.geometry[lake_gdf.COMID == j]
-            cent_val = poly_val.centroid
-            node_colors.append("blue")
-            node_size.append(10)
-        
-        # Set the x and y position of the node based on the centroid of the object
-        G_pos[j] = (np.array([cent_val.x.values[0], cent_val.y.values[0]]))
+    if node_cache is None:
+        node_cache = build_node_cache(lake_gdf, riv_gdf, source)
 
-    # Return the dictionary of positions and the sets of node colors/sizes
-    return G_pos, node_colors, node_size
+    # Look up the rows of all nodes of G at once
+    nodes, rows = _cached_nodes(G, node_cache)
+
+    # Rivers are red, pollutant sources are orange (and larger), and waterbodies are blue
+    node_type   = rows.node_type.values
+    node_colors = np.select([node_type == "river", node_type == "source"], ["red", "orange"], "blue").tolist()
+    node_size   = np.where(node_type == "source", 30, 10).tolist()
 
+    # Return the dictionary of positions and the sets of node colors/sizes
+    return _pos_dict(nodes, rows), node_colors, node_size
 
-def add_source_to_graph(G_old , lake_gdf, river_gdf, source):
+def add_source_to_graph(G_old , lake_gdf, river_gdf, source, max_distance=None):
     """
     This function is a generalization of the function 'add_CAFOS_to_graph'. It operates identically, but has a different name
     """
@@ -841,66 +1869,30 @@ def add_source_to_graph(G_old , lake_gdf, river_gdf, source):
     # Make a copy of the graph passed to this function; this prevents making changes to the original graph, G_old
     G = G_old.copy()
 
-    # Make a list of all nodes in graph G
-    all_nodes = [i for i in G.nodes]
+    # Find the closest node in the graph that is also in the source's huc12 for every source
+    attachments = nearest_source_nodes(G, lake_gdf, river_gdf, source, max_distance)
 
-    # Build a concatenated dataframe containing the COMIDs, huc12 codes, and geometry for all waterbody and river nodes that are in the graph
-    node_df = pd.concat([lake_gdf[["COMID", 'huc12', 'geometry']][lake_gdf.COMID.isin(all_nodes)].copy(), river_gdf[['COMID', 'huc12','geometry']][river_gdf.COMID.isin(all_nodes)].copy()])
-    
-    # Loop through the list of sources
-    for i in range(len(source)):
-        # Define the huc the source is in, the location of the source, and the name of the source
-        huc = source.huc12.iloc[i]
-        point = source.geometry.iloc[i]
-        source_name = source.Node.iloc[i]
-        
-        # Get a dataframe of all waterbody and river nodes in the graph taht are also in the source's hcu12
-        df_in_huc = node_df[node_df.huc12 == huc].copy()
-        df_in_huc = df_in_huc.reset_index(drop=True)
-        
-        # For nodes in the huc, define the distances from the source location
-        distances = df_in_huc.distance(point)
-        
-        # If there are other nodes in the huc, then add an edge from the source to the closest node
-        if len(df_in_huc) != 0:
-            comid_to_connect = df_in_huc.COMID.values[distances == min(distances)][0]
-        
-            G.add_edge(source_name, comid_to_connect)
+    # Add an edge from each source to its closest node
+    G.add_edges_from(zip(attachments.Node.tolist(), attachments.COMID.tolist()))
         
     # Return the graph with the sources added
     return G
 
 
-def color_nodes(G,lake_gdf, riv_gdf, source):
+def color_nodes(G,lake_gdf, riv_gdf, source, node_cache=None):
     """
     This function returns lists of node colors and node sizes; it does the same thing as 'get_pos_dict_with_pollutants',
-    except that it doesn't return the position dictionary. Forming this dictionary is typically the most time consuming
-    part of the function. 
+    except that it doesn't return the position dictionary. Nodes that are not rivers or waterbodies are
+    given the source color. If node_cache (from build_node_cache) is given, the node types are taken from the cache
     """
     
-    # Define lists for node colors and node sizes
-    node_colors= []
-    node_size = []
-    
-    # Loop through the set of all nodes in the graph
-    for j in tqdm((G.nodes)):
-        
-        # If the node is a river node, set the node color as red
-        if np.isin(j, riv_gdf.COMID.values):
-            node_colors.append("red")
-            node_size.append(10)
-        # If the node is a waterbody node, set the node color as blue
-        elif np.isin(j, lake_gdf.COMID.values):
-            node_colors.append("blue")
-            node_size.append(10)
-        # If the node is not a waterbody or river node, it is a source node; set the color as orange
-        else:
-            node_colors.append("orange")
-            node_size.append(10)
-            
-    # Return the lists
-    return node_colors, node_size
-
-
+    if node_cache is None:
+        node_cache = build_node_cache(lake_gdf, riv_gdf)
 
+    # Rivers are red, waterbodies are blue, and any other node (e.g., a source node) is orange
+    node_type   = node_cache.node_type.reindex(list(G.nodes)).values
+    node_colors = np.select([node_type == "river", node_type == "lake"], ["red", "blue"], "orange").tolist()
+    node_size   = [10] * len(node_colors)
 
+    # Return the lists
+    return node_colors, node_size
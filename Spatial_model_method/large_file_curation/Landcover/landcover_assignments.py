@@ -1,111 +1,48 @@
 import geopandas as gpd
-from geopandas.tools import sjoin
 import pandas as pd
-from WI_graph_functions import *
+from landcover_functions import *
 import warnings
 warnings.filterwarnings('ignore')
-import re
-from tqdm import tqdm
-import shapely
 import os
+import sys
 
 path = os.getcwd()
 
-lc = pd.read_pickle("raster_to_gdf.df")
+# The pipeline settings and functions are in the parent directory
+sys.path.append(path + "/..")
+from pipeline_config import N_WORKERS
+from pipeline_functions import run_by_huc8, split_by_envelope, read_layer, write_layer
 
-lc = lc[lc["raster_val"] != 0]
+if __name__ == "__main__":
+    lc = gpd.read_file("raster_to_gdf.gpkg")
 
-print("loaded in land cover")
+    lc = lc[lc["raster_val"] != 0].reset_index(drop = True)
 
-HUC8  = pd.read_pickle(path + "/../WIHUC8.df")
-HUC10 = pd.read_pickle(path + "/../WIHUC10.df")
-HUC12 = pd.read_pickle(path + "/../WIHUC12.df")
-WIcatch = pd.read_pickle(path + "/../WICatch.df")
+    print("loaded in land cover")
 
-print("loaded in hucs")
+    # Only the codes and geometries of the HUCs and catchments are needed
+    HUC8  = read_layer("WIHUC8", columns = ["huc8"])
+    HUC10 = read_layer("WIHUC10", columns = ["huc10", "huc8"])
+    HUC12 = read_layer("WIHUC12", columns = ["huc12", "huc10", "huc8"])
+    WIcatch = read_layer("WICatch", columns = ["GRIDCODE", "huc12"])
 
-lc["huc8"]  = 0
-lc["huc10"] = 0
-lc["huc12"] = 0
+    print("loaded in hucs")
 
-df = pd.DataFrame(columns = lc.columns)
+    # Build the catchment pieces of each HUC12 (trimmed to their HUC10 and HUC8) that land cover is assigned to
+    units = landcover_units(HUC8, HUC10, HUC12, WIcatch, catch_col = "GRIDCODE")
 
-for i in tqdm(range(len(HUC8))):
-    mask = HUC8.geometry.iloc[i]
+    print("DONE WITH UNITS")
 
-    clipping = gpd.clip(lc, mask)
-    
-    clipping["huc8"] = HUC8.huc8.iloc[i]
-    
-    df = df.append(clipping)
+    # Split the land cover polygons by the units and assign the catchment and HUC codes; the units are 
+    # split by HUC8 and each HUC8 is run on a separate process, which is only sent the land cover
+    # polygons that intersect the envelope of the HUC8
+    lc_parts = split_by_envelope(lc, units, units.huc8.values)
+    lc_parts = {key: {"lc": part} for key, part in lc_parts.items()}
+    gdf = run_by_huc8(overlay_landcover_part, units, units.huc8.values, n_workers = N_WORKERS, restore_order = False, part_shared = lc_parts)
+    write_layer(gdf, "land_cover", path = path)
 
-gdf = gpd.GeoDataFrame(df, crs = "EPSG:4326").reset_index(drop = True)
-gdf.to_pickle("land_cover.df")
-
-print("DONE WITH HUC8")
-
-df = pd.DataFrame(columns = lc.columns)
-
-for i in tqdm(range(len(HUC10))):
-    mask = HUC10.geometry.iloc[i]
-
-    huc10_val = HUC10.huc10.iloc[i]
-    huc8_val  = HUC10.huc8.iloc[i]
-
-    huc8_lc = gdf[gdf.huc8 == huc8_val]
-
-    clipping = gpd.clip(huc8_lc, mask)
-    
-    clipping["huc10"] = huc10_val
-    
-    df = df.append(clipping)
-
-
-gdf = gpd.GeoDataFrame(df, crs = "EPSG:4326").reset_index(drop = True)
-gdf.to_pickle("land_cover.df")
-
-print("DONE WITH HUC10")
-
-df = pd.DataFrame(columns = lc.columns)
-
-for i in tqdm(range(len(HUC12))):
-    mask = HUC12.geometry.iloc[i]
-
-    huc12_val = HUC12.huc12.iloc[i]
-    huc10_val = HUC12.huc10.iloc[i]
-
-    huc10_lc = gdf[gdf.huc10 == huc10_val]
-
-    clipping = gpd.clip(huc10_lc, mask)
-    
-    clipping["huc12"] = huc12_val
-    
-    df = df.append(clipping)
-
-gdf = gpd.GeoDataFrame(df, crs = "EPSG:4326").reset_index(drop = True)
-gdf.to_pickle("land_cover.df")
-
-print("DONE WITH HUC12")
-
-lc["catchment"] = 0
-
-df = pd.DataFrame(columns = lc.columns)
-
-for i in tqdm(range(len(WIcatch))):
-    mask = WIcatch.geometry.iloc[i]
-
-    huc12_val     = WIcatch.huc12.iloc[i]
-    catchment_val = WIcatch.GRIDCODE.iloc[i]
-
-    huc12_lc = gdf[gdf.huc12 == huc12_val]
-
-    clipping = gpd.clip(huc12_lc, mask)
-
-    clipping["catchment"] = catchment_val
-
-    df = df.append(clipping)
-
-gdf = gpd.GeoDataFrame(df, crs = "EPSG:4326").reset_index(drop = True)
-
-gdf.to_pickle("land_cover.df")
+    print("DONE WITH LAND COVER ASSIGNMENTS")
 
+    # Save the area of each land cover class in each catchment
+    areas = landcover_area_table(gdf)
+    write_layer(areas, "land_cover_areas", path = path)
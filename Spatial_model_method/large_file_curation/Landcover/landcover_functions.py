@@ -0,0 +1,317 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio
+import rasterio.windows
+from rasterio.features import rasterize, shapes
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from tqdm import tqdm
+import os
+
+
+def _parent_geometries(child_parents, parent_codes, parent_geoms):
+    """
+    Return the geometry of the parent of each child unit by looking up the parent codes. Children
+    whose parent is not in the parent dataframe are given a missing geometry
+    """
+
+    parent_index = pd.Index(parent_codes)
+    if not parent_index.is_unique:
+        raise ValueError("HUC codes must be unique to look up parent watersheds")
+
+    pos   = parent_index.get_indexer(child_parents)
+    geoms = np.full(len(pos), None, dtype=object)
+    geoms[pos >= 0] = parent_geoms[pos[pos >= 0]]
+
+    return geoms
+
+def landcover_units(huc8, huc10, huc12, catch, catch_col="GRIDCODE"):
+    """
+    Build the smallest units that land cover is assigned to. Each unit is the part of a catchment
+    that lies in its own HUC12, which in turn is trimmed to its own HUC10 and HUC8. This is the area
+    that the nested clips (HUC8, then HUC10 within the HUC8, then HUC12 within the HUC10, then the
+    catchment within the HUC12) leave for each catchment
+
+    The nesting is followed through the HUC codes (see add_huc_col_to_hucs), so no spatial search is
+    needed to find the parent of a unit. catch must have a "huc12" column and an identifying column
+    catch_col. Returns a GeoDataFrame with the columns "catchment", "huc12", "huc10", "huc8", and geometry
+    """
+
+    # Trim each HUC12 to its HUC10 and HUC8
+    h12_geoms = huc12.geometry.values
+    h12_geoms = shapely.intersection(h12_geoms, _parent_geometries(huc12.huc10.values, huc10.huc10.values, huc10.geometry.values))
+    h12_geoms = shapely.intersection(h12_geoms, _parent_geometries(huc12.huc8.values, huc8.huc8.values, huc8.geometry.values))
+
+    # Trim each catchment to its (trimmed) HUC12; catchments without a HUC12 are dropped
+    catch_huc12 = catch.huc12.values
+    geoms = shapely.intersection(catch.geometry.values, _parent_geometries(catch_huc12, huc12.huc12.values, h12_geoms))
+    keep  = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+
+    # The HUC10 and HUC8 codes are given by the first digits of the HUC12 code
+    codes = catch_huc12[keep]
+    units = gpd.GeoDataFrame({
+        "catchment": catch[catch_col].values[keep],
+        "huc12":     codes,
+        "huc10":     codes // 100,
+        "huc8":      codes // 10000,
+    }, geometry=geoms[keep], crs=catch.crs)
+
+    return units
+
+def overlay_landcover(lc, units):
+    """
+    Assign each land cover polygon piece to the catchment, HUC12, HUC10, and HUC8 that it lies in with
+    a single pass over the spatial index of the land cover. Each land cover polygon is split by the units
+    (from landcover_units) that it intersects; polygons lying entirely inside a unit are kept whole
+    instead of being intersected
+
+    Returns a GeoDataFrame with the "raster_val" column of lc, the "catchment", "huc12", "huc10", and
+    "huc8" columns of the units, and the geometry of each piece. Pieces with no area are dropped
+    """
+
+    lc_geoms   = lc.geometry.values
+    unit_geoms = units.geometry.values
+
+    # Get all pairs of land cover polygons and units whose geometries intersect
+    unit_idx, lc_idx = lc.sindex.query(unit_geoms, predicate="intersects")
+
+    # Land cover polygons that lie entirely within a unit do not need to be intersected
+    shapely.prepare(unit_geoms)
+    inside = shapely.covers(unit_geoms[unit_idx], lc_geoms[lc_idx])
+
+    pieces = lc_geoms[lc_idx].copy()
+    pieces[~inside] = shapely.intersection(lc_geoms[lc_idx[~inside]], unit_geoms[unit_idx[~inside]])
+
+    # Drop pieces where the polygons only touch
+    keep = shapely.area(pieces) > 0
+    lc_idx, unit_idx = lc_idx[keep], unit_idx[keep]
+
+    gdf = gpd.GeoDataFrame({
+        "raster_val": lc.raster_val.values[lc_idx],
+        "catchment":  units.catchment.values[unit_idx],
+        "huc12":      units.huc12.values[unit_idx],
+        "huc10":      units.huc10.values[unit_idx],
+        "huc8":       units.huc8.values[unit_idx],
+    }, geometry=pieces[keep], crs=lc.crs)
+
+    # Order the pieces by catchment and then by land cover polygon
+    order = np.lexsort((lc_idx, unit_idx))
+    return gdf.iloc[order].reset_index(drop=True)
+
+def overlay_landcover_part(part, shared, key):
+    """
+    Overlay one HUC8 shard of the units with the land cover in shared["lc"] (only the land cover of that
+    HUC8 when it is sent with part_shared). Used with run_by_huc8 (in pipeline_functions.py) to run
+    overlay_landcover on several processes
+    """
+
+    return overlay_landcover(shared["lc"], part)
+
+def landcover_area_table(pieces, area_crs="EPSG:3071"):
+    """
+    Build a tidy table of land cover area by class for every unit. pieces is a GeoDataFrame from
+    overlay_landcover. Areas are computed in area_crs (Wisconsin Transverse Mercator by default) and
+    given in square kilometers. The pieces are not reprojected if they are already in area_crs
+
+    Returns a dataframe with the columns "catchment", "huc12", "huc10", "huc8", "raster_val", and "area_sqkm"
+    """
+
+    table = pd.DataFrame(pieces.drop(columns=pieces.geometry.name))
+    geoms = pieces.geometry if pieces.crs == area_crs else pieces.geometry.to_crs(area_crs)
+    table["area_sqkm"] = geoms.area.values / 1e6
+
+    keys = ["catchment", "huc12", "huc10", "huc8", "raster_val"]
+    return table.groupby(keys, as_index=False, sort=True)["area_sqkm"].sum()
+
+def _empty_counts(dtype):
+    # Cell counts with no zones, for tiles that do not overlap any unit
+    return pd.DataFrame({"zone": np.zeros(0, dtype=np.int64), "raster_val": np.zeros(0, dtype=dtype), "cells": np.zeros(0, dtype=np.int64)})
+
+def _class_counts(zones, image, valid, exclude=(0,)):
+    """
+    Count the raster cells of each class in each zone. zones is an integer array of zone ids (with 0 
+    for cells outside of every zone), image is the array of land cover classes on the same grid, and
+    valid marks the cells with data. Classes in exclude are not counted
+
+    Returns a dataframe with the columns "zone", "raster_val", and "cells"
+    """
+
+    selected = (zones > 0) & valid & ~np.isin(image, exclude)
+    zone_vals = zones[selected].astype(np.int64)
+
+    if len(zone_vals) == 0:
+        return _empty_counts(image.dtype)
+
+    # Count every (zone, class) pair with a single bincount
+    classes, class_idx = np.unique(image[selected], return_inverse=True)
+    counts = np.bincount(zone_vals * len(classes) + class_idx.ravel())
+    pairs  = np.flatnonzero(counts)
+
+    return pd.DataFrame({"zone": pairs // len(classes), "raster_val": classes[pairs % len(classes)], "cells": counts[pairs]})
+
+def _zone_table(counts, units, cell_area):
+    """
+    Convert cell counts by zone (from _class_counts) to the tidy land cover area table of the units. Zone
+    i + 1 is the unit in row i of units
+    """
+
+    counts = counts.groupby(["zone", "raster_val"], as_index=False, sort=True)["cells"].sum()
+    rows   = counts.zone.values - 1
+
+    table = pd.DataFrame({
+        "catchment":  units.catchment.values[rows],
+        "huc12":      units.huc12.values[rows],
+        "huc10":      units.huc10.values[rows],
+        "huc8":       units.huc8.values[rows],
+        "raster_val": counts.raster_val.values.astype(float),
+        "area_sqkm":  counts.cells.values * cell_area,
+    })
+
+    keys = ["catchment", "huc12", "huc10", "huc8", "raster_val"]
+    return table.groupby(keys, as_index=False, sort=True)["area_sqkm"].sum()
+
+def raster_tiles(window, tile_size=4096):
+    """
+    Split a raster window into square tiles of at most tile_size cells on a side. Returns a list of
+    rasterio Windows in row-major order
+    """
+
+    tiles = []
+    for row in range(int(window.row_off), int(window.row_off + window.height), tile_size):
+        for col in range(int(window.col_off), int(window.col_off + window.width), tile_size):
+            height = min(tile_size, int(window.row_off + window.height) - row)
+            width  = min(tile_size, int(window.col_off + window.width) - col)
+            tiles.append(rasterio.windows.Window(col, row, width, height))
+
+    return tiles
+
+def _bounds_window(src, bounds):
+    """
+    Return the window of the raster src (rounded out to whole cells) covering the given bounds
+    """
+
+    full   = rasterio.windows.Window(0, 0, src.width, src.height)
+    window = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+    col_off, row_off = int(np.floor(window.col_off)), int(np.floor(window.row_off))
+
+    return rasterio.windows.Window(col_off, row_off, int(np.ceil(window.col_off + window.width)) - col_off,
+                                   int(np.ceil(window.row_off + window.height)) - row_off).intersection(full)
+
+def _run_tiles(func, tasks, n_workers=1):
+    """
+    Apply func to every task (a tuple of arguments) and yield the results in order. With more than one
+    worker the tasks are run on a process pool, with at most two tasks per worker waiting at a time so 
+    that finished tiles do not pile up in memory
+    """
+
+    if n_workers <= 1:
+        for task in tasks:
+            yield func(*task)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(func, *task))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _zonal_tile(raster_path, window, geoms, zone_ids, exclude):
+    """
+    Count the land cover cells of each class in each zone for one tile of the raster. geoms are the 
+    geometries (in the CRS of the raster) of the zones that overlap the tile
+    """
+
+    with rasterio.open(raster_path) as src:
+        image     = src.read(1, window=window)
+        valid     = src.read_masks(1, window=window) > 0
+        transform = src.window_transform(window)
+
+    # Burn the zone ids onto the grid of the tile
+    zones = rasterize(zip(geoms, zone_ids), out_shape=image.shape, transform=transform, fill=0, dtype="int32")
+
+    return _class_counts(zones, image, valid, exclude)
+
+def zonal_landcover_areas(raster_path, units, exclude=(0,), tile_size=4096, n_workers=1):
+    """
+    Compute the land cover area by class for every unit (from landcover_units) directly from the land
+    cover raster, without converting the raster to polygons. The units are rasterized onto the grid of 
+    the raster (each cell is given to the unit containing the center of the cell), and the cells of each
+    class are counted in each unit. Classes in exclude (by default 0, which has no land cover) are not counted
+
+    Only the part of the raster covering the units is read, one tile of tile_size x tile_size cells at a 
+    time, so memory use is bounded by the tile size. Tiles are processed on n_workers processes. The 
+    result does not depend on the tile size
+
+    The raster must use a projected CRS in meters (Wiscland2 uses EPSG:3071). Returns the same table as
+    landcover_area_table, with the columns "catchment", "huc12", "huc10", "huc8", "raster_val", and "area_sqkm"
+    """
+
+    with rasterio.open(raster_path) as src:
+        units_r   = units if units.crs == src.crs else units.to_crs(src.crs)
+        window    = _bounds_window(src, units_r.total_bounds)
+        cell_area = abs(src.transform.a * src.transform.e) / 1e6
+        tiles     = [(tile, src.window_bounds(tile)) for tile in raster_tiles(window, tile_size)]
+
+    # Give each tile only the units that overlap it; zone ids start at 1
+    geoms = units_r.geometry.values
+    tasks = []
+    for tile, bounds in tiles:
+        idx = units_r.sindex.query(shapely.box(*bounds), predicate="intersects")
+        if len(idx) > 0:
+            tasks.append((raster_path, tile, geoms[idx], idx + 1, exclude))
+
+    counts = list(_run_tiles(_zonal_tile, tasks, n_workers))
+    counts = pd.concat(counts) if len(counts) > 0 else _empty_counts(np.int64)
+
+    return _zone_table(counts, units, cell_area)
+
+def _polygonize_tile(raster_path, window, dst_crs):
+    """
+    Convert one tile of the raster to polygons of equal value. Returns a GeoDataFrame with the column
+    "raster_val" in dst_crs
+    """
+
+    with rasterio.open(raster_path) as src:
+        image     = src.read(1, window=window)
+        mask      = src.read_masks(1, window=window) > 0
+        transform = src.window_transform(window)
+        crs       = src.crs
+
+    geoms = [{"properties": {"raster_val": v}, "geometry": g} for g, v in shapes(image, mask=mask, transform=transform)]
+    gdf   = gpd.GeoDataFrame.from_features(geoms, crs=crs, columns=["geometry", "raster_val"])
+
+    # The tile is only reprojected if dst_crs differs from the CRS of the raster
+    if dst_crs is None or crs == dst_crs:
+        return gdf
+
+    return gdf.to_crs(dst_crs)
+
+def polygonize_raster(raster_path, out_path, tile_size=4096, n_workers=1, dst_crs="EPSG:4326", layer="landcover"):
+    """
+    Convert the land cover raster to polygons one tile at a time and append each tile to the GeoPackage
+    out_path, so that neither the whole raster nor all of its polygons are held in memory. Tiles are
+    processed on n_workers processes and written in order
+
+    Polygons are cut at the tile edges, so a patch of land cover crossing a tile edge is split into
+    several polygons. This does not change the area assigned to any unit. Returns the number of polygons written
+    """
+
+    with rasterio.open(raster_path) as src:
+        tiles = raster_tiles(rasterio.windows.Window(0, 0, src.width, src.height), tile_size)
+
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    n_polygons = 0
+    tasks = [(raster_path, tile, dst_crs) for tile in tiles]
+    for gdf in tqdm(_run_tiles(_polygonize_tile, tasks, n_workers), total=len(tasks)):
+        if len(gdf) > 0:
+            gdf.to_file(out_path, layer=layer, driver="GPKG", mode="a" if n_polygons > 0 else "w")
+            n_polygons += len(gdf)
+
+    return n_polygons
@@ -1,27 +1,19 @@
-import rasterio 
-import rasterio.warp
-import rasterio.features
-from rasterio.features import shapes
 import os
-from shapely.geometry import shape
-import geopandas as gpd
+import sys
+from landcover_functions import polygonize_raster
 
 path = os.getcwd()
 
-print("RUNNING RASTER")
-with rasterio.Env():
-    with rasterio.open("wiscland2_level1.tif") as src:
-        mask = src.dataset_mask()
-        image = src.read(1)
-        results = ( {"properties": {"raster_val": v}, 'geometry': s} for i, (s, v) in enumerate( shapes(image, mask=mask, transform = src.transform)))
+# The size of the raster tiles and the number of processes are set in the parent directory
+sys.path.append(path + "/..")
+from pipeline_config import TILE_SIZE, N_WORKERS, WORKING_CRS
 
+if __name__ == "__main__":
+    print("RUNNING RASTER")
 
-geoms = list(results)
-print(geoms[0])
+    # Convert the raster to polygons one tile at a time and append each tile to the GeoPackage. The polygons
+    # are saved in the working CRS; since Wiscland2 is already in EPSG:3071, the tiles are not reprojected
+    n_polygons = polygonize_raster("wiscland2_level1.tif", path + "/raster_to_gdf.gpkg", tile_size = TILE_SIZE,
+                                   n_workers = N_WORKERS, dst_crs = WORKING_CRS)
 
-print("CONVERTING TO GDF")
-gdf = gpd.GeoDataFrame.from_features(geoms)
-print("Formed GeoDataFrame")
-gdf = gdf.set_crs("EPSG:3071")
-gdf = gdf.to_crs("EPSG:4326")
-gdf.to_pickle(path + "/raster_to_gdf.df")
+    print("Formed GeoPackage with " + str(n_polygons) + " polygons")
@@ -0,0 +1,37 @@
+import pandas as pd
+from landcover_functions import *
+import warnings
+warnings.filterwarnings('ignore')
+import os
+import sys
+
+# This script computes the land cover area of each class in each catchment directly from the Wiscland2
+# raster. It can be used in place of landcover_raster_to_shp.py and landcover_assignments.py when only the
+# land cover areas (and not the land cover polygons) are needed
+
+path = os.getcwd()
+
+# The size of the raster tiles and the number of processes are set in the parent directory
+sys.path.append(path + "/..")
+from pipeline_config import TILE_SIZE, N_WORKERS
+from pipeline_functions import read_layer, write_layer
+
+if __name__ == "__main__":
+    # Only the codes and geometries of the HUCs and catchments are needed
+    HUC8  = read_layer("WIHUC8", columns = ["huc8"])
+    HUC10 = read_layer("WIHUC10", columns = ["huc10", "huc8"])
+    HUC12 = read_layer("WIHUC12", columns = ["huc12", "huc10", "huc8"])
+    WIcatch = read_layer("WICatch", columns = ["GRIDCODE", "huc12"])
+
+    print("loaded in hucs")
+
+    # Build the catchment pieces of each HUC12 (trimmed to their HUC10 and HUC8) that land cover is assigned to
+    units = landcover_units(HUC8, HUC10, HUC12, WIcatch, catch_col = "GRIDCODE")
+
+    print("DONE WITH UNITS")
+
+    # Count the land cover cells of each class in each unit
+    areas = zonal_landcover_areas("wiscland2_level1.tif", units, tile_size = TILE_SIZE, n_workers = N_WORKERS)
+    write_layer(areas, "land_cover_areas", path = path)
+
+    print("DONE WITH ZONAL STATISTICS")
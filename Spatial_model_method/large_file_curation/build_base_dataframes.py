@@ -5,144 +5,152 @@ import geopandas as gpd
 import pandas as pd
 from tqdm import tqdm
 from HydroGraph_functions import *
+from pipeline_functions import parallel_overlay, parallel_assign_hucs, write_layer, read_layer, run_stage, layer_files, read_roi, huc_outline, to_working_crs
+from pipeline_config import N_WORKERS, FORCE_REBUILD, ROI_HUC, WORKING_CRS
+from functools import lru_cache
 import os
 
 warnings.filterwarnings('ignore')
 
 path = os.getcwd()
 
-print("Loading in Data")
-
-# Load in the shape file for Wisconsin
-WI    = gpd.GeoDataFrame.from_file(path + "/../WI/WI.shp")
-
-# Load in the shape files for WBD, NHDFlowlines, and NHDWatgebodies for HUC2 watershed 04
-HUC84   = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed4/WBDHU8.shp")
-HUC104  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed4/WBDHU10.shp")
-HUC124  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed4/WBDHU12.shp")
-lakes4  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed4/NHDWaterbody.shp")
-rivers4 = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed4/NHDFlowline.shp")
-catch4  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed4/Catchment.shp")
-
-# Load in the shape files for WBD, NHDFlowlines, and NHDWatgebodies for HUC2 watershed 07
-HUC87   = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed7/WBDHU8.shp")
-HUC107  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed7/WBDHU10.shp")
-HUC127  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed7/WBDHU12.shp")
-lakes7  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed7/NHDWaterbody.shp")
-rivers7 = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed7/NHDFlowline.shp")
-catch7  = gpd.GeoDataFrame.from_file(path + "/Watersheds/Watershed7/Catchment.shp")
-
-# Add HUC2 code to lakes and rivers; this will be used to remove any objects outside of their HUCs later
-lakes4['huc2']  = 4
-rivers4['huc2'] = 4
-catch4['huc2'] = 4
-
-lakes7['huc2']  = 7
-rivers7['huc2'] = 7
-catch7['huc2'] = 7
-
-print("Setting same EPSG code")
-
-
-# Set the EPSG code to be the same for all shapefiles. This ensures better accuracy when calling "overlay" later
-WI = WI.to_crs("EPSG:4326")
-
-HUC84   = HUC84.to_crs("EPSG:4326")
-HUC104  = HUC104.to_crs("EPSG:4326")
-HUC124  = HUC124.to_crs("EPSG:4326")
-lakes4  = lakes4.to_crs("EPSG:4326")
-rivers4 = rivers4.to_crs("EPSG:4326")
-catch4  = catch4.to_crs("EPSG:4326")
-
-HUC87   = HUC87.to_crs("EPSG:4326")
-HUC107  = HUC107.to_crs("EPSG:4326")
-HUC127  = HUC127.to_crs("EPSG:4326")
-lakes7  = lakes7.to_crs("EPSG:4326")
-rivers7 = rivers7.to_crs("EPSG:4326")
-catch7  = catch7.to_crs("EPSG:4326")
-
-# Remove the Great Lakes
-lakes4 = lakes4[(lakes4.COMID != 904140243) & (lakes4.COMID != 904140248)].copy()
-lakes7 = lakes7[(lakes7.COMID != 904140243) & (lakes7.COMID != 904140248)].copy()
-
-# Remove swamps/marshes
-lakes4 = lakes4[lakes4.FTYPE != "SwampMarsh"].copy()
-lakes7 = lakes7[lakes7.FTYPE != "SwampMarsh"].copy()
-
-# Reset index
-lakes4 = lakes4.reset_index(drop=True)
-lakes7 = lakes7.reset_index(drop=True)
-
-# Add a huc indicator column
-HUC84, HUC104, HUC124 = add_huc_col_to_hucs(HUC84.copy(), HUC104.copy(), HUC124.copy())
-HUC87, HUC107, HUC127 = add_huc_col_to_hucs(HUC87.copy(), HUC107.copy(), HUC127.copy())
-
-HUC8_all   = pd.concat([HUC84, HUC87])
-HUC10_all  = pd.concat([HUC104, HUC107])
-HUC12_all  = pd.concat([HUC124, HUC127])
-
-HUC8_all  = HUC8_all.reset_index(drop=True)
-HUC10_all = HUC10_all.reset_index(drop=True)
-HUC12_all = HUC12_all.reset_index(drop=True)
-
-print("Getting WI HUCs")
-
-HUC8  = gpd.overlay(HUC8_all, WI, how="intersection")
-HUC8  = HUC8[HUC8_all.columns].copy(deep = True)
-print("Done with HUC8")
-HUC10 = gpd.overlay(HUC10_all, WI, how="intersection")
-HUC10 = HUC10[HUC10_all.columns].copy(deep = True)
-print("Done with HUC10")
-HUC12 = gpd.overlay(HUC12_all, WI, how="intersection")
-HUC12 = HUC12[HUC12_all.columns].copy(deep = True)
-print("Done with HUC12")
-
-lakes_all  = pd.concat([lakes4, lakes7])
-rivers_all = pd.concat([rivers4, rivers7])
-catch_all  = pd.concat([catch4, catch7])
-
-lakes_all  = lakes_all.reset_index(drop=True)
-rivers_all = rivers_all.reset_index(drop=True)
-catch_all  = catch_all.reset_index(drop=True)
-
-print("Getting WI lakes and rivers")
-
-lakes  = gpd.overlay(lakes_all, WI, how="intersection")
-lakes  = lakes[lakes_all.columns].copy(deep = True)
-print("Done with lakes")
-rivers = gpd.overlay(rivers_all, WI, how="intersection")
-rivers = rivers[rivers_all.columns].copy(deep = True)
-print("Done with rivers")
-catch = gpd.overlay(catch_all, WI, how = "intersection")
-catch = catch[catch_all.columns].copy(deep = True)
-print("Done with catchments")
-
-print("Adding HUCs to lakes")
-
-# Add the HUC8, HUC10, and HUC12 unit codes to the lakes and rivers
-# These are determined by what HUC the centroid of the lake lies in
-lakes = add_HUC8(lakes.copy(), HUC8.copy())
-lakes = add_HUC10(lakes.copy(), HUC10.copy())
-lakes = add_HUC12(lakes.copy(), HUC12.copy())
-
-print("Adding HUCs to rivers")
-
-rivers = add_HUC8(rivers.copy(), HUC8.copy())
-rivers = add_HUC10(rivers.copy(), HUC10.copy())
-rivers = add_HUC12(rivers.copy(), HUC12.copy())
-
-print("Adding HUCs to catchments")
-catch = add_HUC8(catch.copy(), HUC8.copy())
-catch = add_HUC10(catch.copy(), HUC10.copy())
-catch = add_HUC12(catch.copy(), HUC12.copy())
-
-print("Saving Data")
-
-HUC8.to_pickle(path + "/WIHUC8.df")
-HUC10.to_pickle(path + "/WIHUC10.df")
-HUC12.to_pickle(path + "/WIHUC12.df")
-lakes.to_pickle(path + "/WILakes.df")
-rivers.to_pickle(path + "/WIRivers.df")
-catch.to_pickle(path + "/WICatch.df")
-
-print("Done forming base dataframes")
\ No newline at end of file
+# Shape files used by the stages below
+WI_file = path + "/../WI/WI.shp"
+
+def watershed_files(name):
+    # Files for HUC2 watersheds 04 and 07
+    return [path + "/Watersheds/Watershed4/" + name + ".shp", path + "/Watersheds/Watershed7/" + name + ".shp"]
+
+# The layers below are read and reprojected to the working CRS once, and then reused by every stage run
+# in this process. They are shared, so they must not be modified
+
+@lru_cache(maxsize=None)
+def load_WI(crs):
+
+    # Load in the shape file for Wisconsin in the working CRS
+    WI = gpd.GeoDataFrame.from_file(WI_file)
+    return to_working_crs(WI, crs)
+
+@lru_cache(maxsize=None)
+def load_roi(roi_huc, crs):
+
+    # The region of interest is Wisconsin, or the watershed given by roi_huc
+    if roi_huc is None:
+        return load_WI(crs)
+
+    return to_working_crs(huc_outline(watershed_files("WBDHU" + str(len(roi_huc))), roi_huc), crs)
+
+@lru_cache(maxsize=None)
+def load_huc8_all(roi_huc, crs):
+
+    # Only the HUC8s are needed from the full WBD, for splitting the overlays by HUC8
+    HUC8_all = pd.concat([to_working_crs(read_roi(file, load_roi(roi_huc, crs)), crs) for file in watershed_files("WBDHU8")])
+    HUC8_all["huc8"] = pd.to_numeric(HUC8_all["huc8"]).astype(np.int64)
+    return HUC8_all.reset_index(drop=True)
+
+def load_hucs(roi, crs):
+
+    # Load in the shape files for WBD for HUC2 watersheds 04 and 07, keeping only the HUCs in the region of interest
+    HUC84, HUC87   = [read_roi(file, roi) for file in watershed_files("WBDHU8")]
+    HUC104, HUC107 = [read_roi(file, roi) for file in watershed_files("WBDHU10")]
+    HUC124, HUC127 = [read_roi(file, roi) for file in watershed_files("WBDHU12")]
+
+    # Reproject every shapefile to the working CRS, so that the overlays, centroids, and areas are computed in meters
+    HUC84, HUC104, HUC124 = [to_working_crs(gdf, crs) for gdf in [HUC84, HUC104, HUC124]]
+    HUC87, HUC107, HUC127 = [to_working_crs(gdf, crs) for gdf in [HUC87, HUC107, HUC127]]
+
+    # Add a huc indicator column
+    HUC84, HUC104, HUC124 = add_huc_col_to_hucs(HUC84.copy(), HUC104.copy(), HUC124.copy())
+    HUC87, HUC107, HUC127 = add_huc_col_to_hucs(HUC87.copy(), HUC107.copy(), HUC127.copy())
+
+    HUC8_all   = pd.concat([HUC84, HUC87]).reset_index(drop=True)
+    HUC10_all  = pd.concat([HUC104, HUC107]).reset_index(drop=True)
+    HUC12_all  = pd.concat([HUC124, HUC127]).reset_index(drop=True)
+
+    return HUC8_all, HUC10_all, HUC12_all
+
+def build_hucs(roi_huc, crs):
+
+    WI = load_WI(crs)
+    HUC8_all, HUC10_all, HUC12_all = load_hucs(load_roi(roi_huc, crs), crs)
+
+    print("Getting WI HUCs")
+
+    # Each overlay is split by HUC8, and the HUC8s are run on separate processes
+    HUC8  = parallel_overlay(HUC8_all, WI, None, N_WORKERS)
+    print("Done with HUC8")
+    HUC10 = parallel_overlay(HUC10_all, WI, None, N_WORKERS)
+    print("Done with HUC10")
+    HUC12 = parallel_overlay(HUC12_all, WI, None, N_WORKERS)
+    print("Done with HUC12")
+
+    # Save the dataframes to the layer store as GeoParquet (and Feather for the attributes)
+    write_layer(HUC8, "WIHUC8")
+    write_layer(HUC10, "WIHUC10")
+    write_layer(HUC12, "WIHUC12")
+
+def build_features(shapefile, layer, roi_huc, crs):
+
+    WI  = load_WI(crs)
+    roi = load_roi(roi_huc, crs)
+    HUC8_all = load_huc8_all(roi_huc, crs)
+
+    # Load in the shape files for HUC2 watersheds 04 and 07 (only the features in the region of interest), 
+    # and add the HUC2 code; this will be used to remove any objects outside of their HUCs later
+    gdf4, gdf7 = [read_roi(file, roi) for file in watershed_files(shapefile)]
+    gdf4['huc2'] = 4
+    gdf7['huc2'] = 7
+
+    # Reproject the shapefiles to the working CRS
+    gdf4 = to_working_crs(gdf4, crs)
+    gdf7 = to_working_crs(gdf7, crs)
+
+    gdf_all = pd.concat([gdf4, gdf7]).reset_index(drop=True)
+
+    if shapefile == "NHDWaterbody":
+        # Remove the Great Lakes
+        gdf_all = gdf_all[(gdf_all.COMID != 904140243) & (gdf_all.COMID != 904140248)].copy()
+
+        # Remove swamps/marshes
+        gdf_all = gdf_all[gdf_all.FTYPE != "SwampMarsh"].copy()
+
+        # Reset index
+        gdf_all = gdf_all.reset_index(drop=True)
+
+    print("Getting WI " + layer)
+
+    # Features are split by the HUC8 that their centroid lies in
+    gdf = parallel_overlay(gdf_all, WI, HUC8_all, N_WORKERS)
+
+    print("Adding HUCs to " + layer)
+
+    # Add the HUC8, HUC10, and HUC12 unit codes to the features
+    # These are determined by what HUC the centroid of the feature lies in
+    # Each HUC8 is run on a separate process
+    HUC8  = read_layer("WIHUC8")
+    HUC10 = read_layer("WIHUC10")
+    HUC12 = read_layer("WIHUC12")
+    gdf = parallel_assign_hucs(gdf, HUC8, HUC10, HUC12, N_WORKERS)
+
+    write_layer(gdf, layer)
+
+# The overlays and HUC assignments run on a process pool, so the script must only run as the main module
+if __name__ == "__main__":
+
+    # Each stage is only run if its input files, parameters, or code (including the helper modules and the
+    # loaders in this script) have changed since its last run. Only the features in the region of interest
+    # (ROI_HUC in pipeline_config.py) are read from the shape files, and all layers are saved in the 
+    # working CRS (WORKING_CRS in pipeline_config.py)
+    hucs = ["WIHUC8", "WIHUC10", "WIHUC12"]
+    huc_files = [WI_file] + watershed_files("WBDHU8") + watershed_files("WBDHU10") + watershed_files("WBDHU12")
+    run_stage("hucs", build_hucs, huc_files, layer_files(hucs), params = {"roi_huc": ROI_HUC, "crs": WORKING_CRS}, force = FORCE_REBUILD,
+              modules = [__file__])
+
+    for shapefile, layer in [("NHDWaterbody", "WILakes"), ("NHDFlowline", "WIRivers"), ("Catchment", "WICatch")]:
+        inputs = [WI_file] + watershed_files("WBDHU8") + watershed_files(shapefile) + layer_files(hucs)
+        if ROI_HUC is not None:
+            inputs = inputs + watershed_files("WBDHU" + str(len(ROI_HUC)))
+        run_stage(layer, build_features, inputs, layer_files([layer]), params = {"shapefile": shapefile, "layer": layer, "roi_huc": ROI_HUC, "crs": WORKING_CRS},
+                  force = FORCE_REBUILD, modules = [__file__])
+
+    print("Done forming base dataframes")
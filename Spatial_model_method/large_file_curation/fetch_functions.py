@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import urllib.request
+import urllib.error
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+# Lock for the index of the download cache, which is updated by several threads
+_index_lock = threading.Lock()
+
+def _sha256(file):
+    # SHA-256 hash of the contents of a file, read in blocks
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _read_index(cache_dir):
+    file = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(file):
+        return dict()
+    with open(file) as f:
+        return json.load(f)
+
+def _update_index(cache_dir, url, sha256):
+    with _index_lock:
+        index = _read_index(cache_dir)
+        index[url] = sha256
+        with open(os.path.join(cache_dir, "index.json"), "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+
+def source_url(source, mirror=None):
+    """
+    Return the URL (or local path) that a source is fetched from. If mirror is given, the file is taken
+    from the mirror instead of the original URL: mirror can be a local directory or the base URL of a
+    server (e.g., "http://localhost:8000"), holding each file under the name given in the manifest
+    """
+
+    if mirror is None:
+        return source["url"]
+
+    if os.path.isdir(mirror):
+        return os.path.join(mirror, source["file"])
+
+    return mirror.rstrip("/") + "/" + source["file"]
+
+class IncompleteDownload(IOError):
+    """
+    Raised when a server sends fewer (or more) bytes than it announced. The partial file is kept, so the
+    next attempt resumes it
+    """
+
+def _content_range(header):
+    # Parse a "bytes first-last/total" Content-Range header; total is None if it is not given
+    try:
+        unit, spec = header.split(" ", 1)
+        span, total = spec.split("/")
+        first, last = span.split("-")
+        return int(first), int(last), None if total == "*" else int(total)
+    except (AttributeError, ValueError):
+        return None
+
+def _download(url, part_file, timeout=60):
+    """
+    Download url to part_file. If part_file already holds the start of the file (from an earlier run that
+    was interrupted), only the rest of the file is requested with an HTTP Range header, and the reply is 
+    only appended if it is a 206 reply whose Content-Range starts where the partial file ends. Otherwise
+    (e.g., a server that ignores the range and sends 200) the partial file is replaced by the whole file
+
+    Raises IncompleteDownload if the number of bytes received does not match the Content-Length of the
+    reply, or the file does not have the total size given in the Content-Range
+    """
+
+    start   = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    request = urllib.request.Request(url)
+    if start > 0:
+        request.add_header("Range", "bytes=" + str(start) + "-")
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        # The partial file is already complete (or does not match the file on the server); start over
+        if e.code == 416 and start > 0:
+            os.remove(part_file)
+            return _download(url, part_file, timeout)
+        raise
+
+    with response:
+        total = None
+        if start > 0 and response.status == 206:
+            content_range = _content_range(response.headers.get("Content-Range"))
+            if content_range is None or content_range[0] != start:
+                # The reply does not continue the partial file; start over without a range
+                response.close()
+                os.remove(part_file)
+                return _download(url, part_file, timeout)
+            total = content_range[2]
+            mode  = "ab"
+        elif response.status == 200:
+            mode = "wb"
+        else:
+            raise IncompleteDownload("Unexpected HTTP status " + str(response.status) + " for " + url)
+
+        length = response.headers.get("Content-Length")
+        with open(part_file, mode) as f:
+            received = 0
+            for block in iter(lambda: response.read(1 << 20), b""):
+                f.write(block)
+                received += len(block)
+
+    if length is not None and received != int(length):
+        raise IncompleteDownload("Received " + str(received) + " of " + length + " bytes of " + url)
+    if total is not None and os.path.getsize(part_file) != total:
+        raise IncompleteDownload("Downloaded " + str(os.path.getsize(part_file)) + " of " + str(total) + " bytes of " + url)
+
+def _read_lock(lock_file):
+    if lock_file is None or not os.path.exists(lock_file):
+        return dict()
+    with open(lock_file) as f:
+        return json.load(f)
+
+def fetch(source, cache_dir, mirror=None, retries=3):
+    """
+    Fetch one source of the manifest into the download cache and return the path of the cached file.
+    A source is a dictionary with the keys "name", "url", "file" (the name of the file), and optionally
+    "sha256" and "size" (the expected SHA-256 hash and size in bytes of the file)
+
+    Files are stored in cache_dir under their SHA-256 hash, so a source that is already in the cache is
+    not downloaded again. Interrupted downloads are resumed on the next attempt, and failed or incomplete
+    downloads are retried up to retries times. Raises a ValueError if the downloaded file does not have
+    the expected size or hash
+    """
+
+    objects = os.path.join(cache_dir, "objects")
+    partial = os.path.join(cache_dir, "partial")
+    os.makedirs(objects, exist_ok=True)
+    os.makedirs(partial, exist_ok=True)
+
+    url      = source_url(source, mirror)
+    expected = source.get("sha256")
+    size     = source.get("size")
+
+    # The cache is keyed by the hash of the contents; the index gives the hash for each original URL
+    cached = _read_index(cache_dir).get(source["url"], expected)
+    if cached is not None and os.path.exists(os.path.join(objects, cached)):
+        if (expected is None or cached == expected) and (size is None or os.path.getsize(os.path.join(objects, cached)) == size):
+            print("Using cached " + source["file"])
+            return os.path.join(objects, cached)
+
+    part_file = os.path.join(partial, hashlib.sha256(url.encode()).hexdigest() + ".part")
+
+    for attempt in range(retries + 1):
+        try:
+            if os.path.isdir(mirror or ""):
+                shutil.copyfile(url, part_file)
+            else:
+                _download(url, part_file)
+            break
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            if attempt == retries:
+                raise
+            print("Retrying " + source["file"] + " after error: " + str(e))
+            time.sleep(2 ** attempt)
+
+    if size is not None and os.path.getsize(part_file) != size:
+        got = os.path.getsize(part_file)
+        os.remove(part_file)
+        raise ValueError("Size of " + source["file"] + " does not match: expected " + str(size) + " bytes, got " + str(got))
+
+    sha256 = _sha256(part_file)
+    if expected is not None and sha256 != expected:
+        os.remove(part_file)
+        raise ValueError("Checksum of " + source["file"] + " does not match: expected " + expected + ", got " + sha256)
+
+    os.replace(part_file, os.path.join(objects, sha256))
+    _update_index(cache_dir, source["url"], sha256)
+    print("Downloaded " + source["file"])
+
+    return os.path.join(objects, sha256)
+
+def fetch_all(sources, cache_dir, mirror=None, n_workers=4, retries=3, lock_file=None):
+    """
+    Fetch every source of the manifest (see fetch) on a pool of n_workers threads. Returns a dictionary
+    with the path of the cached file for each source name
+
+    If lock_file is given, it holds the SHA-256 hash and size of every source URL. Sources without a
+    "sha256" or "size" are checked against the lock file, and the hash and size of sources that are not 
+    in the lock file yet are added to it once they are fetched, so every later fetch (and use of the 
+    cache) is checked against them. Commit the lock file to pin the datasets
+    """
+
+    lock    = _read_lock(lock_file)
+    pinned  = [dict(lock.get(source["url"], dict()), **{k: v for k, v in source.items() if v is not None}) for source in sources]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        paths = list(executor.map(lambda source: fetch(source, cache_dir, mirror, retries), pinned))
+
+    if lock_file is not None:
+        for source, file in zip(sources, paths):
+            lock.setdefault(source["url"], {"sha256": os.path.basename(file), "size": os.path.getsize(file)})
+        with open(lock_file, "w") as f:
+            json.dump(lock, f, indent=1, sort_keys=True)
+
+    return {source["name"]: file for source, file in zip(sources, paths)}
@@ -1,19 +1,47 @@
-import wget
 import os
 import zipfile
 import py7zr
 import shutil
+from fetch_functions import fetch_all
+from pipeline_config import DOWNLOAD_CACHE, N_DOWNLOADS, DATA_MIRROR
 
 path = os.getcwd()
 
-# Download the landcover data: https://p.widencdn.net/lkfpeb/wiscland2_landcover
-
-landcover_url = "https://p.widencdn.net/lkfpeb/wiscland2_landcover"
-wget.download(landcover_url, out = path)
+# Manifest of the datasets to download. Each file is saved in the download cache under the hash of its 
+# contents, so it is only downloaded once. The SHA-256 hash and size of each file are pinned in 
+# data_sources.lock.json (written when a file is first downloaded, and checked on every later download), 
+# and a "sha256" or "size" key can be added to a source to check it against a known value instead
+
+sources = [
+    # The landcover data: https://p.widencdn.net/lkfpeb/wiscland2_landcover
+    {"name": "landcover", "file": "wiscland2_landcover.zip", "url": "https://p.widencdn.net/lkfpeb/wiscland2_landcover"},
+    # Dane County data
+    {"name": "hydrologic_units", "file": "HydrologicUnits.zip", "url": "https://dciimages.countyofdane.com/WaterResources/HydrologicUnits.zip"},
+    {"name": "internally_drained", "file": "InternallyDrained.zip", "url": "https://dciimages.countyofdane.com/WaterResources/InternallyDrained.zip"},
+    # NHDPlusV2 data for HUC04 and HUC07
+    {"name": "watershed4", "file": "NHDPlusV21_GL_04_NHDSnapshot_08.7z",
+     "url": "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusGL/NHDPlusV21_GL_04_NHDSnapshot_08.7z"},
+    {"name": "watershed7", "file": "NHDPlusV21_MS_07_NHDSnapshot_08.7z",
+     "url": "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusMS/NHDPlus07/NHDPlusV21_MS_07_NHDSnapshot_08.7z"},
+    # Watershed Boundary Dataset for HUC04 and HUC07
+    {"name": "wbd4", "file": "WBD_04_HU2_Shape.zip", "url": "https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography/WBD/HU2/Shape/WBD_04_HU2_Shape.zip"},
+    {"name": "wbd7", "file": "WBD_07_HU2_Shape.zip", "url": "https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography/WBD/HU2/Shape/WBD_07_HU2_Shape.zip"},
+    # Catchment data for HUC04 and HUC07
+    {"name": "catchment4", "file": "NHDPlusV21_GL_04_NHDPlusCatchment_05.7z",
+     "url": "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusGL/NHDPlusV21_GL_04_NHDPlusCatchment_05.7z"},
+    {"name": "catchment7", "file": "NHDPlusV21_MS_07_NHDPlusCatchment_01.7z",
+     "url": "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusMS/NHDPlus07/NHDPlusV21_MS_07_NHDPlusCatchment_01.7z"},
+]
+
+# Download all of the datasets at the same time (or take them from the cache or the mirror in pipeline_config.py)
+lock_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_sources.lock.json")
+archives  = fetch_all(sources, DOWNLOAD_CACHE, mirror = DATA_MIRROR, n_workers = N_DOWNLOADS, lock_file = lock_file)
+
+# Unpack the datasets; the downloaded files stay in the cache
 
 landcover_path = path + "/Landcover/"
 
-with zipfile.ZipFile("wiscland2_landcover.zip", 'r') as zipObj:
+with zipfile.ZipFile(archives["landcover"], 'r') as zipObj:
     zipObj.extract("wiscland2/wiscland2_dataset/level1.zip", path = path)
 
 with zipfile.ZipFile(path + "/wiscland2/wiscland2_dataset/level1.zip", 'r') as zipObj:
@@ -21,16 +49,13 @@ with zipfile.ZipFile(path + "/wiscland2/wiscland2_dataset/level1.zip", 'r') as z
 
 os.rename(landcover_path + "level1/wiscland2_level1.tif", landcover_path + "wiscland2_level1.tif")
 
-os.remove(path + "/wiscland2_landcover.zip")
 shutil.rmtree(landcover_path + "level1")
 
-# Download HydrologicUnits Data
-HU_url = "https://dciimages.countyofdane.com/WaterResources/HydrologicUnits.zip"
-wget.download(HU_url, out = path)
+# Unpack HydrologicUnits Data
 
 county_path = path + "/DaneCountyData/"
 
-with zipfile.ZipFile("HydrologicUnits.zip", 'r') as zipObj:
+with zipfile.ZipFile(archives["hydrologic_units"], 'r') as zipObj:
     zipObj.extract("HydrologicUnits.shx", path = county_path)
     zipObj.extract("HydrologicUnits.cpg", path = county_path)
     zipObj.extract("HydrologicUnits.dbf", path = county_path)
@@ -39,14 +64,11 @@ with zipfile.ZipFile("HydrologicUnits.zip", 'r') as zipObj:
     zipObj.extract("HydrologicUnits.shp", path = county_path)
 
 
-os.remove(path + "/HydrologicUnits.zip")
-
-ID_url = "https://dciimages.countyofdane.com/WaterResources/InternallyDrained.zip"
-wget.download(ID_url, out = path)
+# Unpack InternallyDrained Data
 
 county_path = path + "/DaneCountyData/"
 
-with zipfile.ZipFile("InternallyDrained.zip", 'r') as zipObj:
+with zipfile.ZipFile(archives["internally_drained"], 'r') as zipObj:
     zipObj.extract("InternallyDrained.shx", path = county_path)
     zipObj.extract("InternallyDrained.cpg", path = county_path)
     zipObj.extract("InternallyDrained.dbf", path = county_path)
@@ -54,20 +76,15 @@ with zipfile.ZipFile("InternallyDrained.zip", 'r') as zipObj:
     zipObj.extract("InternallyDrained.sbn", path = county_path)
     zipObj.extract("InternallyDrained.shp", path = county_path)
 
-os.remove(path + "/InternallyDrained.zip")
-
-# Download HUC04 NHDPlusV2 data
-
-watershed4_url = "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusGL/NHDPlusV21_GL_04_NHDSnapshot_08.7z"
-wget.download(watershed4_url, out = path)
+# Unpack HUC04 NHDPlusV2 data
 
 # Extract data from .7z file
 
 watershed4_path = path + "/Watersheds/Watershed4/"
-with py7zr.SevenZipFile("NHDPlusV21_GL_04_NHDSnapshot_08.7z", 'r') as z:
+with py7zr.SevenZipFile(archives["watershed4"], 'r') as z:
     z.extractall(path)
 
-# Move data to proper folder, and then delete the unnecessary unpacked data and the .7z file
+# Move data to proper folder, and then delete the unnecessary unpacked data
 
 NHDPlus4_path = path + "/NHDPlusGL/NHDPlus04/NHDSnapshot/Hydrography/"
 
@@ -82,20 +99,16 @@ shutil.move(NHDPlus4_path + "NHDWaterbody.prj", watershed4_path)
 shutil.move(NHDPlus4_path + "NHDWaterbody.shx", watershed4_path)
 
 shutil.rmtree(path + "/NHDPlusGL")
-os.remove(path + "/NHDPlusV21_GL_04_NHDSnapshot_08.7z")
-
-# Download HUC07 NHDPlusV2 data
 
-watershed7_url = "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusMS/NHDPlus07/NHDPlusV21_MS_07_NHDSnapshot_08.7z"
-wget.download(watershed7_url, out = path)
+# Unpack HUC07 NHDPlusV2 data
 
 # Extract data from .7z file
 
 watershed7_path = path + "/Watersheds/Watershed7/"
-with py7zr.SevenZipFile("NHDPlusV21_MS_07_NHDSnapshot_08.7z", 'r') as z:
+with py7zr.SevenZipFile(archives["watershed7"], 'r') as z:
     z.extractall(path)
     
-# Move data to proper folder, and then delete the unnecessary unpacked data and the .7z file
+# Move data to proper folder, and then delete the unnecessary unpacked data
     
 NHDPlus7_path = path + "/NHDPlusMS/NHDPlus07/NHDSnapshot/Hydrography/"
 
@@ -109,19 +122,13 @@ shutil.move(NHDPlus7_path + "NHDWaterbody.prj", watershed7_path)
 shutil.move(NHDPlus7_path + "NHDWaterbody.shx", watershed7_path)
 
 shutil.rmtree(path + "/NHDPlusMS")
-os.remove(path + "/NHDPlusV21_MS_07_NHDSnapshot_08.7z")
 
 
-# Download the Watershed Boundary Dataset for HUC04
-
-wbd4_url = "https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography/WBD/HU2/Shape/WBD_04_HU2_Shape.zip"
-wget.download(wbd4_url, out = path)
-
-# Unpack the dataset, move the necessary files, and remove the remaining files and zip file
+# Unpack the Watershed Boundary Dataset for HUC04, move the necessary files, and remove the remaining files
 
 watershed4_path = path + "/Watersheds/Watershed4/"
 
-with zipfile.ZipFile("WBD_04_HU2_Shape.zip", 'r') as zipObj:
+with zipfile.ZipFile(archives["wbd4"], 'r') as zipObj:
     zipObj.extractall(path = path)
 
 shutil.move(path + "/Shape/WBDHU8.dbf", watershed4_path)
@@ -137,21 +144,15 @@ shutil.move(path + "/Shape/WBDHU12.prj", watershed4_path)
 shutil.move(path + "/Shape/WBDHU12.shp", watershed4_path)
 shutil.move(path + "/Shape/WBDHU12.shx", watershed4_path)
     
-os.remove(path + "/WBD_04_HU2_Shape.zip")
 os.remove(path + "/WBD_04_HU2_Shape.jpg")
 os.remove(path + "/WBD_04_HU2_Shape.xml")
 shutil.rmtree(path + "/Shape")
 
-# Download the Watershed Boundary Dataset for HUC07
-
-wbd7_url = "https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography/WBD/HU2/Shape/WBD_07_HU2_Shape.zip"
-wget.download(wbd7_url, out = path)
-
-# Unpack the dataset, move the necessary files, and remove the remaining files and zip file
+# Unpack the Watershed Boundary Dataset for HUC07, move the necessary files, and remove the remaining files
 
 watershed7_path = path + "/Watersheds/Watershed7/"
 
-with zipfile.ZipFile("WBD_07_HU2_Shape.zip", 'r') as zipObj:
+with zipfile.ZipFile(archives["wbd7"], 'r') as zipObj:
     zipObj.extractall(path = path)
 
 shutil.move(path + "/Shape/WBDHU8.dbf", watershed7_path)
@@ -167,23 +168,20 @@ shutil.move(path + "/Shape/WBDHU12.prj", watershed7_path)
 shutil.move(path + "/Shape/WBDHU12.shp", watershed7_path)
 shutil.move(path + "/Shape/WBDHU12.shx", watershed7_path)
 
-os.remove(path + "/WBD_07_HU2_Shape.zip")
 os.remove(path + "/WBD_07_HU2_Shape.jpg")
 os.remove(path + "/WBD_07_HU2_Shape.xml")
 shutil.rmtree(path + "/Shape")
 
 
-# Download Catchment Data for HUC4
-catchment4_url = "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusGL/NHDPlusV21_GL_04_NHDPlusCatchment_05.7z"
-wget.download(catchment4_url, out = path)
+# Unpack Catchment Data for HUC4
 
 # Extract data from .7z file
 
 watershed4_path = path + "/Watersheds/Watershed4/"
-with py7zr.SevenZipFile("NHDPlusV21_GL_04_NHDPlusCatchment_05.7z", 'r') as z:
+with py7zr.SevenZipFile(archives["catchment4"], 'r') as z:
     z.extractall(path)
 
-# Move data to proper folder, and then delete the unnecessary unpacked data and the .7z file
+# Move data to proper folder, and then delete the unnecessary unpacked data
 
 NHDPlus4_path = path + "/NHDPlusGL/NHDPlus04/NHDPlusCatchment/"
 
@@ -193,20 +191,17 @@ shutil.move(NHDPlus4_path + "Catchment.prj", watershed4_path)
 shutil.move(NHDPlus4_path + "Catchment.shx", watershed4_path)
 
 shutil.rmtree(path + "/NHDPlusGL")
-os.remove(path + "/NHDPlusV21_GL_04_NHDPlusCatchment_05.7z")
 
 
-# Download Catchment Data for HUC7
-catchment7_url = "https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NHDPlusMS/NHDPlus07/NHDPlusV21_MS_07_NHDPlusCatchment_01.7z"
-wget.download(catchment7_url, out = path)
+# Unpack Catchment Data for HUC7
 
 # Extract data from .7z file
 
 watershed7_path = path + "/Watersheds/Watershed7/"
-with py7zr.SevenZipFile("NHDPlusV21_MS_07_NHDPlusCatchment_01.7z", 'r') as z:
+with py7zr.SevenZipFile(archives["catchment7"], 'r') as z:
     z.extractall(path)
 
-# Move data to proper folder, and then delete the unnecessary unpacked data and the .7z file
+# Move data to proper folder, and then delete the unnecessary unpacked data
 
 NHDPlus7_path = path + "/NHDPlusMS/NHDPlus07/NHDPlusCatchment/"
 
@@ -216,4 +211,3 @@ shutil.move(NHDPlus7_path + "Catchment.prj", watershed7_path)
 shutil.move(NHDPlus7_path + "Catchment.shx", watershed7_path)
 
 shutil.rmtree(path + "/NHDPlusMS")
-os.remove(path + "/NHDPlusV21_MS_07_NHDPlusCatchment_01.7z")
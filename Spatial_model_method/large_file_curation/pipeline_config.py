@@ -0,0 +1,40 @@
+import os
+
+# Settings shared by the scripts in large_file_curation
+
+# Number of processes used by the stages that are split by HUC8 (see pipeline_functions.py) and by
+# the tiled land cover scripts. Set to 1 to run everything in a single process
+N_WORKERS = os.cpu_count()
+
+# Size (in cells) of the square tiles that the land cover raster is read in
+TILE_SIZE = 4096
+
+# Directory of the layer store (see write_layer and read_layer in pipeline_functions.py), where the
+# outputs of each stage are saved as GeoParquet and Feather files
+STORE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Set to True to rebuild every stage, even when its inputs have not changed (see run_stage in pipeline_functions.py)
+FORCE_REBUILD = False
+
+# Region of interest. Only features that intersect the region are read from the shape files, which
+# avoids decoding most of HUC2 watersheds 04 and 07. If ROI_HUC is None, the region is the state of 
+# Wisconsin; otherwise it is the HUC8, HUC10, or HUC12 watershed with the given code, given as a string 
+# with its leading zero (e.g., "07090002" for the Upper Rock River HUC8, which contains the Lake Mendota 
+# headwaters)
+ROI_HUC = None
+
+# CRS that every layer is reprojected to (once, when it is first read) and that all overlays, centroids, 
+# and areas are computed in. Wisconsin Transverse Mercator (EPSG:3071) is in meters and is also the CRS 
+# of the Wiscland2 land cover raster, so the land cover polygons do not need to be reprojected
+WORKING_CRS = "EPSG:3071"
+
+# Directory of the download cache used by get_and_unpack_data.py (see fetch_functions.py). Downloaded
+# files are kept here under the hash of their contents, so they are only downloaded once
+DOWNLOAD_CACHE = os.path.join(STORE_PATH, "download_cache")
+
+# Number of files downloaded at the same time by get_and_unpack_data.py
+N_DOWNLOADS = 4
+
+# Local directory or base URL of a mirror holding the downloaded files (under the names given in 
+# get_and_unpack_data.py). If None, the files are downloaded from their original URLs
+DATA_MIRROR = None
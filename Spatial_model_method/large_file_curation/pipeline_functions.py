@@ -0,0 +1,421 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyarrow.parquet
+import pyarrow.feather
+import os
+import json
+import glob
+import hashlib
+import inspect
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from HydroGraph_functions import _assign_codes
+from pipeline_config import STORE_PATH, WORKING_CRS
+
+# Read-only data (e.g., the Wisconsin outline or the HUC GeoDataFrames) shared by all tasks of a worker.
+# It is sent to each worker once when the worker starts, rather than once for every task
+_shared = None
+
+def _set_shared(shared):
+    global _shared
+    _shared = shared
+
+def _run_part(func, key, part, part_shared=None):
+    # Data sent with a single shard is added to the data shared by every shard
+    shared = _shared if part_shared is None else dict(_shared or dict(), **part_shared)
+    return func(part, shared, key)
+
+def huc8_keys(gdf, huc8=None):
+    """
+    Return the HUC8 code of every row of gdf, used to split gdf into shards. If huc8 is None, the
+    "huc8" column of gdf is used; otherwise each row is given the code of the HUC8 polygon that its
+    centroid lies in (0 if it is not in any HUC8), as in assign_hucs
+    """
+
+    if huc8 is None:
+        return np.asarray(gdf.huc8.values, dtype=np.int64)
+
+    return _assign_codes(gdf.centroid, huc8.geometry, huc8.huc8.values)
+
+def run_by_huc8(func, gdf, keys, shared=None, n_workers=1, restore_order=True, part_shared=None):
+    """
+    Split gdf into one shard for each HUC8 code in keys, and call func(part, shared, key) on every shard.
+    With more than one worker, the shards are run on a process pool; shared is sent to each worker once.
+    func must be a module-level function so that it can be sent to the workers
+
+    part_shared is an optional dictionary giving, for each HUC8 code, a dictionary of data that is only 
+    needed by that shard (e.g., the rows of a large layer that lie in the HUC8, from split_by_envelope). 
+    It is sent with the shard and added to shared for that call only
+
+    Results are merged in order of HUC8 code, so the output does not depend on the order in which the
+    shards finish. If restore_order is True, each part is given a "_row" column holding the position of
+    each row in gdf; func must keep this column, and the merged result is put back into the order of gdf
+    (rows created from the same row of gdf keep the order that func gave them)
+    """
+
+    keys = np.asarray(keys)
+    shard_keys, inverse = np.unique(keys, return_inverse=True)
+
+    # Build the shards; rows keep their order in gdf within each shard
+    order  = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(shard_keys) + 1))
+    parts  = []
+    for i in range(len(shard_keys)):
+        rows = order[bounds[i]:bounds[i + 1]]
+        part = gdf.iloc[rows].copy()
+        if restore_order:
+            part["_row"] = rows
+        parts.append(part)
+    shard_keys = shard_keys.tolist()
+
+    part_shared = [None if part_shared is None else part_shared[key] for key in shard_keys]
+
+    if n_workers <= 1 or len(parts) <= 1:
+        _set_shared(shared)
+        results = [_run_part(func, key, part, extra) for key, part, extra in zip(shard_keys, parts, part_shared)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_shared, initargs=(shared,)) as executor:
+            results = list(executor.map(_run_part, [func] * len(parts), shard_keys, parts, part_shared))
+
+    if len(results) == 0:
+        return gdf.iloc[:0].copy()
+
+    merged = pd.concat(results)
+    if restore_order:
+        merged = merged.iloc[np.argsort(merged["_row"].values, kind="stable")].drop(columns="_row")
+
+    return merged.reset_index(drop=True)
+
+def split_by_envelope(data, gdf, keys):
+    """
+    Return a dictionary giving, for each HUC8 code in keys (one code for each row of gdf, as in 
+    run_by_huc8), the rows of data that intersect the envelope of the rows of gdf with that code. 
+    The rows of data keep their order. All envelopes are looked up with a single query of the spatial
+    index of data, so each shard can be sent only the part of data it needs
+    """
+
+    keys = np.asarray(keys)
+    shard_keys, inverse = np.unique(keys, return_inverse=True)
+
+    # Envelope of each shard from the bounds of its rows
+    bounds = gdf.geometry.bounds.values
+    xmin = np.full(len(shard_keys), np.inf)
+    ymin = np.full(len(shard_keys), np.inf)
+    xmax = np.full(len(shard_keys), -np.inf)
+    ymax = np.full(len(shard_keys), -np.inf)
+    np.fmin.at(xmin, inverse, bounds[:, 0])
+    np.fmin.at(ymin, inverse, bounds[:, 1])
+    np.fmax.at(xmax, inverse, bounds[:, 2])
+    np.fmax.at(ymax, inverse, bounds[:, 3])
+    envelopes = shapely.box(xmin, ymin, xmax, ymax)
+
+    # One query for all envelopes; the results are sorted by envelope and split into one set of rows each
+    env_idx, data_idx = data.sindex.query(envelopes, predicate="intersects")
+    order  = np.lexsort((data_idx, env_idx))
+    splits = np.searchsorted(env_idx[order], np.arange(1, len(shard_keys)))
+    rows   = np.split(data_idx[order], splits)
+
+    return {key: data.iloc[r] for key, r in zip(shard_keys.tolist(), rows)}
+
+def clip_to_mask(gdf, mask):
+    """
+    Intersect gdf with mask (e.g., the outline of Wisconsin), keeping only the columns of gdf. Gives the 
+    same rows, in the same order, as gpd.overlay(gdf, mask, how = "intersection")[gdf.columns]
+
+    The spatial index of mask is used to find the features that lie inside a single row of mask (most
+    features, when the mask is the state outline); these are kept as they are. The exact intersection 
+    is only computed, with gpd.overlay, for the features that cross the edge of the mask. Features that
+    do not intersect the mask are dropped
+    """
+
+    mask = mask[[mask.geometry.name]]
+
+    # gpd.overlay repairs invalid geometries before intersecting them, so the shortcut is only used
+    # for valid geometries (and not at all if the mask is invalid)
+    if not mask.geometry.is_valid.all():
+        return gpd.overlay(gdf, mask, how="intersection")[gdf.columns].reset_index(drop=True)
+
+    geoms = gdf.geometry.values
+
+    # Number of mask rows that each feature intersects, and whether a mask row covers the feature
+    hits   = np.bincount(mask.sindex.query(geoms, predicate="intersects")[0], minlength=len(gdf))
+    inside = np.zeros(len(gdf), dtype=bool)
+    inside[mask.sindex.query(geoms, predicate="covered_by")[0]] = True
+    inside &= (hits == 1) & shapely.is_valid(geoms)
+    crossing = ~inside & (hits > 0)
+
+    # Features inside the mask are their own intersection with it
+    kept = gdf[inside].copy()
+    kept["_clip_row"] = np.flatnonzero(inside)
+    parts = [kept]
+
+    if crossing.any():
+        part = gdf[crossing].copy()
+        part["_clip_row"] = np.flatnonzero(crossing)
+        parts.append(gpd.overlay(part, mask, how="intersection")[part.columns])
+
+    # Put the rows back into the order of gdf; a feature crossing several mask rows keeps the order
+    # given by gpd.overlay
+    clipped = pd.concat(parts)
+    clipped = clipped.iloc[np.argsort(clipped["_clip_row"].values, kind="stable")].drop(columns="_clip_row")
+
+    return clipped.reset_index(drop=True)
+
+def overlay_part(part, shared, key):
+    """
+    Intersect a shard with the mask in shared["mask"] (e.g., the outline of Wisconsin), keeping only the
+    columns of the shard (see clip_to_mask)
+    """
+
+    return clip_to_mask(part, shared["mask"])
+
+def assign_hucs_part(part, shared, key):
+    """
+    Add the HUC8, HUC10, and HUC12 codes to a shard whose centroids lie in the HUC8 given by key. Only
+    the HUC10s and HUC12s of that HUC8 are searched, which gives the same codes as assign_hucs over all HUCs
+    """
+
+    part = part.copy()
+
+    # Rows that are not in any HUC8 are not in any HUC10 or HUC12 either
+    if key == 0:
+        part["huc8"], part["huc10"], part["huc12"] = 0, 0, 0
+        return part
+
+    huc10 = shared["huc10"][shared["huc10"].huc8 == key]
+    huc12 = shared["huc12"][shared["huc12"].huc8 == key]
+    points = part.centroid
+
+    part["huc8"]  = key
+    part["huc10"] = _assign_codes(points, huc10.geometry, huc10.huc10.values)
+    part["huc12"] = _assign_codes(points, huc12.geometry, huc12.huc12.values, part.huc10.values, huc12.huc10.values)
+
+    return part
+
+def parallel_overlay(gdf, mask, huc8, n_workers=1):
+    """
+    Intersect gdf with mask (as gpd.overlay with how = "intersection", keeping only the columns of gdf),
+    with gdf split into shards by the HUC8 that each feature lies in. Only the features crossing the edge
+    of mask are intersected (see clip_to_mask). Returns the rows in the same order as the overlay of the
+    whole dataframe
+    """
+
+    return run_by_huc8(overlay_part, gdf, huc8_keys(gdf, huc8), {"mask": mask}, n_workers)
+
+def parallel_assign_hucs(shp, huc8, huc10, huc12, n_workers=1):
+    """
+    Add HUC8, HUC10, and HUC12 codes to shp (as assign_hucs), with shp split into shards by HUC8. The
+    HUC8 of each feature is found first, and the HUC10 and HUC12 codes of each shard are then found on a
+    separate process
+    """
+
+    print("Running parallel_assign_hucs over GeoPandas dataframe")
+
+    keys = huc8_keys(shp, huc8)
+    return run_by_huc8(assign_hucs_part, shp, keys, {"huc10": huc10, "huc12": huc12}, n_workers)
+
+def read_roi(file, mask=None):
+    """
+    Read a shape file, keeping only the features that intersect mask (a GeoDataFrame, GeoSeries, or 
+    shapely geometry, such as the outline from huc_outline). The mask is passed to the reader, so 
+    features outside of it are skipped without being decoded. If the mask has a CRS, it is reprojected
+    to the CRS of the file
+    """
+
+    return gpd.read_file(file, mask=mask)
+
+def to_working_crs(gdf, crs=WORKING_CRS):
+    """
+    Return gdf in the given CRS (the pipeline's working CRS by default). gdf is returned as it is when it 
+    is already in that CRS, so layers are only reprojected once
+    """
+
+    if gdf.crs is not None and gdf.crs == crs:
+        return gdf
+
+    return gdf.to_crs(crs)
+
+def huc_outline(files, code):
+    """
+    Return a GeoDataFrame with the outline of the watershed with the given HUC code (a string such as
+    "0709000205"), read from the WBD shape files of its level (e.g., WBDHU10.shp for a 10 digit code). 
+    Only the rows with the given code are decoded
+    """
+
+    level = len(code)
+    parts = [gpd.read_file(file, where="huc" + str(level) + " = '" + code + "'") for file in files]
+    parts = [part for part in parts if len(part) > 0]
+
+    if len(parts) == 0:
+        raise ValueError("HUC" + str(level) + " " + code + " was not found")
+
+    outline = pd.concat([part.to_crs(parts[0].crs) for part in parts])
+    return gpd.GeoDataFrame(geometry=[outline.geometry.union_all()], crs=parts[0].crs)
+
+def write_layer(df, name, path=STORE_PATH):
+    """
+    Save a dataframe to the layer store under the given name. The whole dataframe is saved as a 
+    (Geo)Parquet file, name.parquet; GeoDataFrames also get a bounding box column so that they can be
+    read with a bounding box filter. The attribute (non-geometry) columns are also saved as an
+    uncompressed Feather file, name.feather, so that they can be read as a memory-mapped table. The 
+    index is not saved
+    """
+
+    df = df.reset_index(drop=True)
+
+    if isinstance(df, gpd.GeoDataFrame):
+        df.to_parquet(os.path.join(path, name + ".parquet"), index=False, write_covering_bbox=True)
+        attributes = pd.DataFrame(df.drop(columns=df.geometry.name))
+    else:
+        df.to_parquet(os.path.join(path, name + ".parquet"), index=False)
+        attributes = df
+
+    pyarrow.feather.write_feather(attributes, os.path.join(path, name + ".feather"), compression="uncompressed")
+
+def read_layer(name, columns=None, bbox=None, path=STORE_PATH):
+    """
+    Read a dataframe from the layer store. Only the given columns are read (the geometry column is
+    always read for GeoDataFrames). If bbox = (minx, miny, maxx, maxy) is given, only the features whose
+    bounding box intersects bbox are read
+    """
+
+    file = os.path.join(path, name + ".parquet")
+    metadata = pyarrow.parquet.read_schema(file).metadata or {}
+
+    # Layers without geo metadata were saved from a plain DataFrame
+    if b"geo" not in metadata:
+        return pd.read_parquet(file, columns=columns)
+
+    if columns is not None:
+        geometry = json.loads(metadata[b"geo"])["primary_column"]
+        columns  = list(columns) + [geometry] if geometry not in columns else list(columns)
+
+    return gpd.read_parquet(file, columns=columns, bbox=bbox)
+
+def read_attributes(name, columns=None, path=STORE_PATH):
+    """
+    Read the attribute (non-geometry) columns of a layer from its memory-mapped Feather file. Only the
+    given columns are read from disk, and no geometries are decoded
+    """
+
+    table = pyarrow.feather.read_table(os.path.join(path, name + ".feather"), columns=columns, memory_map=True)
+    return table.to_pandas()
+
+def layer_files(names, path=STORE_PATH):
+    """
+    Return the files written by write_layer for each of the given layer names
+    """
+
+    return [os.path.join(path, name + ext) for name in names for ext in [".parquet", ".feather"]]
+
+def _dataset_files(file):
+    # A shapefile is stored in several files with the same name (.shp, .dbf, .shx, .prj, ...)
+    if file.endswith(".shp"):
+        return sorted(glob.glob(file[:-4] + ".*"))
+    return [file]
+
+def _file_hash(file, cache):
+    """
+    Return the SHA-256 hash of the contents of a file. Hashes are kept in cache keyed by the path, size, 
+    and modification time of the file, so unchanged files are not read again
+    """
+
+    stat  = os.stat(file)
+    entry = cache.get(file)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    cache[file] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+    return digest.hexdigest()
+
+# Modules whose source is part of every stage key: the helpers that the stages call, and the settings
+STAGE_MODULES = ["pipeline_functions", "HydroGraph_functions", "pipeline_config"]
+
+def _module_hash(module):
+    # SHA-256 hash of the source file of a module, given by name, as a module object, or as the path of
+    # its file (e.g., __file__ of a script)
+    if isinstance(module, str) and module.endswith(".py"):
+        origin = module
+    else:
+        spec   = importlib.util.find_spec(module) if isinstance(module, str) else module.__spec__
+        origin = None if spec is None else spec.origin
+    if origin is None or not os.path.exists(origin):
+        return str(module)
+    with open(origin, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def stage_key(name, inputs, params=None, func=None, cache=None, modules=None):
+    """
+    Return a key for a stage built from the contents of its input files, its parameters, (if func is
+    given) the source code of the function that runs it, and the source of the modules in STAGE_MODULES
+    and modules (names, module objects, or file paths of other modules the stage depends on). The key changes 
+    whenever any of these change, so editing a helper function or a setting such as WORKING_CRS in 
+    pipeline_config.py rebuilds the stage
+    """
+
+    cache  = dict() if cache is None else cache
+    digest = hashlib.sha256(name.encode())
+
+    for file in inputs:
+        for part in _dataset_files(file):
+            digest.update(os.path.basename(part).encode())
+            digest.update(_file_hash(part, cache).encode())
+
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    if func is not None:
+        # Functions defined interactively have no source file; only their name is used
+        try:
+            digest.update(inspect.getsource(func).encode())
+        except (OSError, TypeError):
+            digest.update(func.__qualname__.encode())
+
+    for module in STAGE_MODULES + list(modules or []):
+        digest.update(_module_hash(module).encode())
+
+    return digest.hexdigest()
+
+def run_stage(name, func, inputs, outputs, params=None, force=False, path=STORE_PATH, modules=None):
+    """
+    Run func(**params) for the stage called name, unless the stage is up to date. A stage is up to date if
+    all of its output files exist and its key (see stage_key) is the same as when it was last run. Keys 
+    and file hashes are kept in the manifest file build_manifest.json in path, so stages depending on the
+    outputs of a stage that was rebuilt are rebuilt as well. modules lists other modules that the stage
+    depends on besides STAGE_MODULES (see stage_key). Returns True if the stage was run
+    """
+
+    params   = dict() if params is None else params
+    manifest_file = os.path.join(path, "build_manifest.json")
+
+    manifest = {"stages": {}, "files": {}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    key = stage_key(name, inputs, params, func, manifest["files"], modules)
+    up_to_date = manifest["stages"].get(name) == key and all(os.path.exists(file) for file in outputs)
+
+    if up_to_date and not force:
+        print("Stage " + name + " is up to date")
+        run = False
+    else:
+        print("Running stage " + name)
+        func(**params)
+        manifest["stages"][name] = key
+        run = True
+
+    # Record the hashes of the outputs now, so that later stages do not need to read them again
+    for file in outputs:
+        for part in _dataset_files(file):
+            _file_hash(part, manifest["files"])
+
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    return run
@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+
+# Files of a stream data store; every array is saved as a .npy file so that it can be memory-mapped
+_STORE_ARRAYS = ["stations", "offsets", "dates", "discharge", "tp"]
+
+def _csv_hash(csv_file):
+    # SHA-256 hash of the contents of the csv file the store was built from
+    digest = hashlib.sha256()
+    with open(csv_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class StreamDataStore:
+    """
+    Station-partitioned store of the stream data (stream_data.csv, with the columns ID, Date, Discharge,
+    and TP). The rows are sorted by station and date, and the dates, discharge, and TP concentration are
+    held as contiguous arrays (days since 1970-01-01, and float64) saved as memory-mapped .npy files. The
+    rows of each station are a single slice of these arrays, found from the sorted station IDs by binary
+    search, and a date range within a station is found the same way
+
+    Build the store once with StreamDataStore.build (or open_stream_data, which only rebuilds the store
+    when the csv file changes), and open it with StreamDataStore(path)
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        arrays    = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in _STORE_ARRAYS}
+
+        # Sorted station IDs, and the first row of each station (with the number of rows at the end)
+        self.stations  = arrays["stations"]
+        self.offsets   = arrays["offsets"]
+        self.dates     = arrays["dates"]
+        self.discharge = arrays["discharge"]
+        self.tp        = arrays["tp"]
+
+    @classmethod
+    def build(cls, csv_file, path):
+        """
+        Parse the csv file once and save it as a store in the directory path. Returns the opened store
+        """
+
+        df = pd.read_csv(csv_file, dtype={"ID": str})
+        df["Date"] = pd.to_datetime(df.Date, format="%m/%d/%Y")
+        df = df.sort_values(["ID", "Date"], kind="stable").reset_index(drop=True)
+
+        stations, starts = np.unique(np.array(df.ID.tolist(), dtype=str), return_index=True)
+
+        arrays = {
+            "stations":  stations,
+            "offsets":   np.append(starts, len(df)).astype(np.int64),
+            "dates":     df.Date.values.astype("datetime64[D]").astype(np.int64),
+            "discharge": df.Discharge.values.astype(np.float64),
+            "tp":        df.TP.values.astype(np.float64),
+        }
+
+        os.makedirs(path, exist_ok=True)
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(values))
+
+        # Record the csv file the store was built from, so that open_stream_data can tell if it changed
+        with open(os.path.join(path, "source.json"), "w") as f:
+            json.dump({"csv_file": os.path.abspath(csv_file), "sha256": _csv_hash(csv_file)}, f, indent=1)
+
+        return cls(path)
+
+    def station_rows(self, station):
+        """
+        Return the first and last (exclusive) row of the given station. Raises a KeyError if the station
+        is not in the store
+        """
+
+        i = np.searchsorted(self.stations, station)
+        if i == len(self.stations) or self.stations[i] != station:
+            raise KeyError("Station " + str(station) + " is not in the stream data")
+
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def _rows(self, station, start=None, end=None):
+        """
+        Return the first and last (exclusive) row of the given station with dates from start to end
+        (inclusive). Either bound can be None
+        """
+
+        first, last = self.station_rows(station)
+        dates = self.dates[first:last]
+
+        lo = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start), "D").astype(np.int64), side="left")
+        hi = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end), "D").astype(np.int64), side="right")
+
+        return first + int(lo), first + int(hi)
+
+    def arrays(self, station, start=None, end=None):
+        """
+        Return the dates (as datetime64[D]), discharge, and TP concentration of a station from start to end
+        (inclusive; either bound can be None) as a dictionary of arrays. The discharge and TP arrays are
+        views of the memory-mapped files, so nothing is copied
+        """
+
+        lo, hi = self._rows(station, start, end)
+
+        return {
+            "Date":      self.dates[lo:hi].astype("datetime64[D]"),
+            "Discharge": self.discharge[lo:hi],
+            "TP":        self.tp[lo:hi],
+        }
+
+    def station_frame(self, station, start=None, end=None):
+        """
+        Return the data of a station from start to end (inclusive; either bound can be None) as a
+        dataframe with the columns of stream_data.csv; dates are given as datetimes
+        """
+
+        data = self.arrays(station, start, end)
+
+        return pd.DataFrame({
+            "ID":        station,
+            "Date":      data["Date"].astype("datetime64[ns]"),
+            "Discharge": np.array(data["Discharge"]),
+            "TP":        np.array(data["TP"]),
+        })
+
+    def to_frame(self, stations=None):
+        """
+        Return the data of the given stations (all stations if stations is None) as a dataframe with the
+        columns of stream_data.csv, sorted by station and date
+        """
+
+        stations = self.stations if stations is None else stations
+        frames   = [self.station_frame(station) for station in stations]
+
+        if len(frames) == 0:
+            return pd.DataFrame(columns=["ID", "Date", "Discharge", "TP"])
+
+        return pd.concat(frames).reset_index(drop=True)
+
+def open_stream_data(csv_file, path=None):
+    """
+    Open the stream data store for csv_file, building it first if it does not exist or if the csv file
+    has changed since the store was built. By default, the store is kept in the directory
+    csv_file + ".store" (e.g., stream_data.csv.store)
+    """
+
+    path   = csv_file + ".store" if path is None else path
+    source = os.path.join(path, "source.json")
+
+    if os.path.exists(source) and all(os.path.exists(os.path.join(path, name + ".npy")) for name in _STORE_ARRAYS):
+        with open(source) as f:
+            if json.load(f)["sha256"] == _csv_hash(csv_file):
+                return StreamDataStore(path)
+
+    return StreamDataStore.build(csv_file, path)